@@ -0,0 +1,287 @@
+"""
+benchmarks: time each encoder stage on synthetic video
+
+Usage:
+    benchmarks [options]
+
+Options:
+    --frames <n>            Frames per fixture [default: 90]
+    --fixture <name>        Only run this fixture (static, pan, noise, cuts, mono)
+    --rounds <n>            Run all fixtures this many times, keeping each stage's median [default: 3]
+    --baseline <file>       Stored results to compare against [default: benchmarks/baseline.json]
+    --save-baseline         Store these results as the new baseline
+    --tolerance <fraction>  Flag stages more than this much slower than baseline [default: 0.25]
+
+Run from the repo root with `python -m benchmarks`, no ffmpeg needed. Stages
+are compared to the baseline relative to a fixed reference workload timed in
+the same run, so baselines carry over between machines of a similar kind.
+Fixtures with regressions are timed again before they are reported.
+"""
+
+import io
+import json
+import math
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import docopt
+import numpy as np
+
+from libcdg import instructions
+from libcdg.constants import *
+from libcdg.libcdg import Video
+from libcdg.palette import PaletteMapper, kmeans_444
+from libcdg.sources import ArraySource
+
+from .fixtures import FIXTURES
+
+# frames to cluster for palette, same as the encoder default
+PALETTE_SAMPLES = 64
+
+# best of at least this many runs is reported for each stage
+REPEAT = 3
+
+# and runs are repeated until they have taken at least this many seconds in total
+MIN_SECONDS = 0.2
+
+# frames of reference work timed alongside each stage
+REFERENCE_FRAMES = 10
+
+# times flagged fixtures are benched again before their regressions are reported
+CONFIRM = 2
+
+# quick stages are run back to back in each timing, until they do this many packets worth of work
+MIN_PACKETS = 1000
+
+
+def reference(frames=REFERENCE_FRAMES):
+    "fixed work for `frames` frames that encoder changes do not affect, both numpy and plain python"
+    rng = np.random.default_rng(0)
+    shape = (FULL_HEIGHT_BLOCKS, FULL_WIDTH_BLOCKS, BLOCK_HEIGHT, BLOCK_WIDTH)
+    prev, next = rng.integers(0, PALETTE_SIZE, (2, *shape), dtype=np.uint8)
+    for _ in range(frames):
+        order = np.count_nonzero(prev != next, axis=(-2, -1)).argsort(axis=None)
+        np.bincount(next.ravel(), minlength=PALETTE_SIZE)
+        prev = np.roll(prev, 1, axis=1)
+        # per block bookkeeping in plain python, like packet writing does
+        b"".join(bytes(divmod(i, FULL_WIDTH_BLOCKS)) for i in order.tolist())
+
+
+def timed(fn, *args, packets: int = None, **kwargs):
+    """
+    run `fn` for a while, returning its result, the fastest time for one call
+    in seconds, and the fastest time for the reference workload in between
+
+    Calls doing less than MIN_PACKETS of `packets` are timed in batches, so
+    each timing is long enough to measure reliably. The reference is timed
+    alternately with `fn`, so both see the machine going at the same speed.
+    """
+    batch = math.ceil(MIN_PACKETS / packets) if packets else 1
+
+    best = best_ref = float("inf")
+    runs = total = 0
+    while runs < REPEAT or total < MIN_SECONDS:
+        for _ in range(REPEAT):
+            start = time.perf_counter()
+            reference()
+            ref = time.perf_counter() - start
+            best_ref = min(best_ref, ref)
+            total += ref
+
+        start = time.perf_counter()
+        for _ in range(batch):
+            result = fn(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+
+        best = min(best, elapsed / batch)
+        runs += 1
+        total += elapsed
+    return result, best, best_ref
+
+
+def bench_fixture(frames: np.ndarray) -> dict[str, dict[str, float]]:
+    "time each encoder stage over `frames`, returns frames (and packets) per second by stage"
+    count = len(frames)
+    results = {}
+
+    def record(stage, timing, frames=count, packets=None):
+        "store rates for `stage` from `timed()` results, and of the reference timed alongside it"
+        seconds, reference_seconds = timing
+        results[stage] = {"fps": frames / seconds, "reference_fps": REFERENCE_FRAMES / reference_seconds}
+        if packets is not None:
+            results[stage]["pps"] = packets / seconds
+
+    video = Video(ArraySource(frames), palette_samples=PALETTE_SAMPLES)
+
+    # palette derivation
+    samples = video.source.sample(PALETTE_SAMPLES)
+    _, *t = timed(kmeans_444, samples)
+    record("palette", t, frames=len(samples))
+
+    # frame quantization
+    mapper = PaletteMapper(video.palette)
+    quantized, *t = timed(lambda: [mapper(f) for f in frames])
+    record("quantize", t)
+
+    # block squashing
+    blocks, *t = timed(lambda: [video.image_to_blocks(q) for q in quantized])
+    record("image_to_blocks", t)
+
+    # frame diff, against previous frame as the screen
+    screens = [np.zeros_like(blocks[0])] + blocks[:-1]
+    updates, *t = timed(lambda: [video.calc_updates(b, s) for b, s in zip(blocks, screens)])
+    record("calc_updates", t)
+
+    # most changed blocks, as the encoder would write them
+    picks = [u.top_indices(video.PACKETS_PER_FRAME) for u in updates]
+    data = [u.blocks[rows, cols] for u, (rows, cols) in zip(updates, picks)]
+    written = sum(len(d) for d in data)
+
+    def write_each():
+        for d, (rows, cols) in zip(data, picks):
+            for block, row, col in zip(d, rows, cols):
+                video.write_block(block, int(row), int(col))
+
+    _, *t = timed(write_each, packets=written)
+    record("write_block", t, packets=written)
+
+    # batch packet assembly into a frame buffer
+    buffer = instructions.packet_buffer(video.PACKETS_PER_FRAME)
+
+    def assemble():
+        for d, (rows, cols) in zip(data, picks):
+            buffer[:] = 0
+            video.write_blocks(d, rows, cols, out=buffer[: len(d)])
+
+    _, *t = timed(assemble)
+    record("packet_assembly", t, packets=count * video.PACKETS_PER_FRAME)
+
+    # whole encode loop, streamed
+    def encode():
+        sink = io.BytesIO()
+        video.encode(sink=sink)
+        return sink.getvalue()
+
+    stream, *t = timed(encode)
+    record("encode", t, packets=len(stream) // PACKET_SIZE)
+
+    # writing out .cdg (audio needs ffmpeg, so left out)
+    video.packets = [stream[i : i + PACKET_SIZE] for i in range(0, len(stream), PACKET_SIZE)]
+
+    def save(path):
+        with open(path, "wb") as cdgfile:
+            cdgfile.writelines(video.packets)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        _, *t = timed(save, Path(tmp, "out.cdg"))
+    record("save", t, packets=len(video.packets))
+
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    list stages that are slower than `baseline` by more than `tolerance`
+
+    Each stage is compared by how fast it runs relative to the reference
+    workload timed alongside it, so the machine being faster or slower
+    overall cancels out. Stages that produce packets are compared by packets
+    per second, so ones that only write a few packets are not judged per frame.
+    """
+    regressions = []
+    for fixture, stages in results.items():
+        for stage, metrics in stages.items():
+            base = baseline.get(fixture, {}).get(stage)
+            if not base:
+                continue
+            if "reference_fps" not in base:
+                regressions.append(f"{fixture}/{stage}: baseline has no reference to compare against, re-save it")
+                continue
+
+            rate = "pps" if "pps" in metrics and "pps" in base else "fps"
+            relative = metrics[rate] / metrics["reference_fps"]
+            base_relative = base[rate] / base["reference_fps"]
+            if relative < base_relative * (1 - tolerance):
+                regressions.append(
+                    f"{fixture}/{stage}: {relative:.3f}x reference {rate}"
+                    f" vs {base_relative:.3f}x baseline ({metrics[rate]:.1f} vs {base[rate]:.1f} {rate})"
+                )
+    return regressions
+
+
+def run_rounds(fixtures: dict, rounds: dict, count: int) -> dict[str, dict[str, dict[str, float]]]:
+    """
+    bench each of `fixtures` `count` more times, adding each stage's results
+    to `rounds`, and return the median of all rounds so far for each stage
+
+    Rounds are spread out over time, so a machine that is busy for a while
+    only skews some, and the middle one by speed relative to the reference is
+    kept, so one lucky round does not skew the results either.
+    """
+    for _ in range(count):
+        for name, frames in fixtures.items():
+            for stage, metrics in bench_fixture(frames).items():
+                rounds[name].setdefault(stage, []).append(metrics)
+
+    results = {}
+    for name in fixtures:
+        results[name] = {}
+        for stage, runs in rounds[name].items():
+            runs.sort(key=lambda metrics: metrics["fps"] / metrics["reference_fps"])
+            results[name][stage] = runs[len(runs) // 2]
+    return results
+
+
+def main():
+    args = docopt.docopt(__doc__)
+    frame_count = int(args["--frames"])
+    names = [args["--fixture"]] if args["--fixture"] else list(FIXTURES)
+    baseline_path = Path(args["--baseline"])
+
+    fixtures = {name: FIXTURES[name](frame_count) for name in names}
+
+    rounds = {name: {} for name in names}
+    results = run_rounds(fixtures, rounds, int(args["--rounds"]))
+
+    for name in names:
+        print(f"== {name} ({frame_count} frames)")
+        for stage, metrics in results[name].items():
+            pps = f"{metrics['pps']:>12.0f} packets/s" if "pps" in metrics else ""
+            print(f"  {stage:<16} {metrics['fps']:>10.1f} fps {pps}")
+
+    if args["--save-baseline"]:
+        baseline_path.write_text(json.dumps(results, indent=2) + "\n")
+        print(f"saved baseline to {baseline_path}")
+        return
+
+    if not baseline_path.exists():
+        print("no baseline to compare against, use --save-baseline to store one")
+        return
+
+    baseline = json.loads(baseline_path.read_text())
+    tolerance = float(args["--tolerance"])
+    regressions = compare(results, baseline, tolerance)
+
+    # a busy spell can still slow a stage in most rounds, so flagged fixtures are timed again
+    for _ in range(CONFIRM):
+        flagged = {line.split("/")[0] for line in regressions}
+        if not flagged:
+            break
+        print(f"timing {', '.join(sorted(flagged))} again to confirm")
+        retry = run_rounds({name: fixtures[name] for name in flagged}, rounds, int(args["--rounds"]))
+        results.update(retry)
+        regressions = compare(results, baseline, tolerance)
+
+    if regressions:
+        print("REGRESSIONS:")
+        for line in regressions:
+            print(f"  {line}")
+        sys.exit(1)
+
+    print("no regressions against baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import numpy as np
+
+from libcdg.constants import *
+
+"""
+Synthetic video fixtures, generated with numpy so no decoder is needed.
+
+Each fixture is an (N, height, width, 3) array of RGB24 frames at full CD+G
+canvas size.
+"""
+
+SHAPE = (FULL_HEIGHT, FULL_WIDTH)
+
+
+def _scene(rng: np.random.Generator, height=FULL_HEIGHT, width=FULL_WIDTH) -> np.ndarray:
+    "smooth-ish random picture: coarse color patches over a gradient"
+    patches = rng.integers(0, 256, (height // 24 + 1, width // 20 + 1, 3), dtype=np.uint8)
+    patches = np.kron(patches, np.ones((24, 20, 1), dtype=np.uint8))[:height, :width]
+
+    ys, xs = np.mgrid[0:height, 0:width]
+    gradient = ((ys / height + xs / width) * 64).astype(np.uint8)[..., None]
+
+    return patches // 2 + gradient
+
+
+def static(frames: int, seed=0) -> np.ndarray:
+    "one picture that never changes"
+    return np.repeat(_scene(np.random.default_rng(seed))[None], frames, axis=0)
+
+
+def pan(frames: int, seed=0, speed=2) -> np.ndarray:
+    "slow horizontal pan across a wider picture"
+    wide = _scene(np.random.default_rng(seed), width=FULL_WIDTH + frames * speed)
+    return np.stack([wide[:, i * speed : i * speed + FULL_WIDTH] for i in range(frames)])
+
+
+def noise(frames: int, seed=0) -> np.ndarray:
+    "every pixel random every frame, worst case for everything"
+    return np.random.default_rng(seed).integers(0, 256, (frames, *SHAPE, 3), dtype=np.uint8)
+
+
+def cuts(frames: int, seed=0, scene_length=15) -> np.ndarray:
+    "unrelated static pictures, with a hard cut every `scene_length` frames"
+    rng = np.random.default_rng(seed)
+    scenes = [_scene(rng) for _ in range(frames // scene_length + 1)]
+    return np.stack([scenes[i // scene_length] for i in range(frames)])
+
+
+def mono(frames: int, seed=0) -> np.ndarray:
+    "black and white shapes moving around (a la Bad Apple)"
+    rng = np.random.default_rng(seed)
+    ys, xs = np.mgrid[0 : FULL_HEIGHT, 0 : FULL_WIDTH]
+
+    centers = rng.uniform((0, 0), SHAPE, (4, 2))
+    velocity = rng.uniform(-4, 4, (4, 2))
+    radii = rng.uniform(20, 60, 4)
+
+    out = np.zeros((frames, *SHAPE, 3), dtype=np.uint8)
+    for i in range(frames):
+        cy, cx = (centers + velocity * i).T
+        inside = ((ys[None] - cy[:, None, None]) ** 2 + (xs[None] - cx[:, None, None]) ** 2) < radii[:, None, None] ** 2
+        # overlapping shapes cancel out
+        out[i][np.logical_xor.reduce(inside)] = 255
+    return out
+
+
+FIXTURES = {
+    "static": static,
+    "pan": pan,
+    "noise": noise,
+    "cuts": cuts,
+    "mono": mono,
+}
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+"""
+cdg2frames: decode CD+G graphics back to video frames, as a player would show them
+
+Usage:
+    cdg2frames <input.cdg> <output> [options]
+
+Options:
+    --images            Write a directory of numbered PNGs instead of raw frames
+    --fps <n>           Frames per second to render [default: 15]
+
+Raw output is RGB24 at 300x216, and can be viewed with e.g.:
+    ffplay -f rawvideo -pixel_format rgb24 -video_size 300x216 -framerate 15 <output>
+"""
+
+import docopt
+
+from libcdg import decoder
+
+ARGS = docopt.docopt(__doc__)
+
+count = decoder.render(
+    ARGS["<input.cdg>"],
+    ARGS["<output>"],
+    frame_rate=int(ARGS["--fps"]),
+    images=ARGS["--images"],
+)
+print(f"rendered {count} frames to {ARGS['<output>']}")
@@ -0,0 +1,120 @@
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+
+import ffmpeg
+
+"""
+Audio track export, run alongside the video encode.
+"""
+
+# encoder to use for each output format
+AUDIO_CODECS = {
+    "mp3": "libmp3lame",
+    "ogg": "libvorbis",
+    "opus": "libopus",
+    "m4a": "aac",
+    "flac": "flac",
+    "wav": "pcm_s16le",
+}
+
+# source codecs (as ffprobe names them) that can be copied into each format as-is
+COPYABLE_CODECS = {
+    "mp3": {"mp3"},
+    "ogg": {"vorbis", "opus", "flac"},
+    "opus": {"opus"},
+    "m4a": {"aac", "alac"},
+    "flac": {"flac"},
+    "wav": {"pcm_s16le", "pcm_s24le", "pcm_f32le"},
+}
+
+
+class AudioExport:
+    """
+    Extracts the audio of file `source` with ffmpeg in the background.
+
+    Audio is written to a temporary file as soon as `start()` is called, and
+    moved into place by `finish()`, so it can run while the video encodes.
+    With `copy`, the audio stream is copied without re-encoding if the source
+    codec already fits the output `format`.
+    """
+
+    log = logging.getLogger("libcdg.audio")
+
+    def __init__(self, source: str, format="mp3", bitrate: str = None, copy=False, quiet=True) -> None:
+        assert format in AUDIO_CODECS, f"unknown audio format {format}!"
+
+        self.source = source
+        self.format = format
+        self.bitrate = bitrate
+        self.copy = copy
+        self.quiet = quiet
+
+        self.process: subprocess.Popen | None = None
+        self.path: str | None = None
+
+    def can_copy(self) -> bool:
+        "whether the source audio codec fits the output format as-is"
+        streams = ffmpeg.probe(self.source, select_streams="a")["streams"]
+        return bool(streams) and streams[0]["codec_name"] in COPYABLE_CODECS[self.format]
+
+    def options(self) -> dict:
+        "ffmpeg output options for the audio"
+        if self.copy:
+            if self.can_copy():
+                return {"acodec": "copy"}
+            self.log.info(f"source audio does not fit {self.format}, re-encoding")
+
+        options = {"acodec": AUDIO_CODECS[self.format]}
+        if self.bitrate:
+            options["audio_bitrate"] = self.bitrate
+        return options
+
+    def start(self):
+        "start extracting audio in the background, if not already running"
+        if self.process:
+            return self
+
+        with tempfile.NamedTemporaryFile(prefix="libcdg_audio_", suffix=f".{self.format}", delete=False) as f:
+            self.path = f.name
+
+        self.log.debug(f"extracting audio to {self.path}")
+        self.process = (
+            ffmpeg.input(self.source)
+            .audio.output(self.path, **self.options())
+            # no stdin, so it does not fight over the terminal while running in the background
+            .global_args("-hide_banner", "-nostdin", *(["-loglevel", "error"] if self.quiet else []))
+            .overwrite_output()
+            .run_async()
+        )
+        return self
+
+    def finish(self, path: str | os.PathLike, overwrite=False):
+        "wait for extraction to finish, and move the audio to `path`"
+        self.start()
+
+        if self.process.wait() != 0:
+            self.cancel()
+            raise ffmpeg.Error("ffmpeg", None, None)
+
+        if os.path.exists(path) and not overwrite:
+            self.cancel()
+            raise FileExistsError(f"{path} already exists!")
+
+        shutil.move(self.path, path)
+        self.process = self.path = None
+
+    def __del__(self):
+        # dont leave a background process or temp file behind if never finished
+        self.cancel()
+
+    def cancel(self):
+        "stop extraction if still running, and remove its output"
+        if self.process:
+            self.process.kill()
+            self.process.wait()
+        if self.path and os.path.exists(self.path):
+            os.unlink(self.path)
+        self.process = self.path = None
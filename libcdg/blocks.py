@@ -0,0 +1,266 @@
+import itertools
+
+import numpy as np
+
+from .constants import *
+from .types import FullFrame
+
+"""
+Vectorized operations on whole frames of block tiles.
+
+Frames here are numpy arrays of palette indices, grouped into blocks of shape
+(rows, cols, BLOCK_HEIGHT, BLOCK_WIDTH).
+"""
+
+
+def to_blocks(arr: np.ndarray) -> FullFrame:
+    "groups 2d array of palette indices into (rows, cols, 12, 6) array of block tiles"
+    # adapted from: https://stackoverflow.com/a/16858283
+
+    h, w = arr.shape
+    assert h % BLOCK_HEIGHT == 0, f"{h} rows is not evenly divisible by {BLOCK_HEIGHT}"
+    assert w % BLOCK_WIDTH == 0, f"{w} cols is not evenly divisible by {BLOCK_WIDTH}"
+
+    return arr.reshape(h // BLOCK_HEIGHT, BLOCK_HEIGHT, w // BLOCK_WIDTH, BLOCK_WIDTH).swapaxes(1, 2)
+
+
+def palette_distances(palette: list[tuple[int, int, int]]) -> np.ndarray:
+    "16x16 table of squared RGB distances between palette entries"
+
+    # unused entries are black, same as the padding in `set_palette`
+    colors = np.zeros((PALETTE_SIZE, 3), dtype=np.int64)
+    colors[: len(palette)] = palette[:PALETTE_SIZE]
+
+    delta = colors[:, None, :] - colors[None, :, :]
+    return (delta**2).sum(axis=-1)
+
+
+def color_weights(palette: list[tuple[int, int, int]]) -> np.ndarray:
+    """
+    16x16 table of how different palette entries look to a viewer.
+
+    Uses the "redmean" weighted RGB distance, which tracks perceived color
+    difference much better than plain RGB for the cost of a few multiplies,
+    scaled so that black to white is 1.
+    """
+
+    # unused entries are black, same as the padding in `set_palette`
+    colors = np.zeros((PALETTE_SIZE, 3), dtype=np.float64)
+    colors[: len(palette)] = palette[:PALETTE_SIZE]
+
+    def redmean(a, b):
+        rmean = (a[..., 0] + b[..., 0]) / 2
+        dr, dg, db = np.moveaxis(a - b, -1, 0)
+        return np.sqrt((2 + rmean / 256) * dr**2 + 4 * dg**2 + (2 + (255 - rmean) / 256) * db**2)
+
+    scale = redmean(np.zeros(3), np.full(3, 255.0))
+    return (redmean(colors[:, None, :], colors[None, :, :]) / scale).astype(np.float32)
+
+
+def pair_costs(distances: np.ndarray) -> np.ndarray:
+    """
+    Cost of drawing palette color `p` with the closer of color pair (a, b).
+
+    Returned as a (16, 16*16) matrix indexed by [p, a*16 + b], so that a block's
+    color histogram times this matrix gives the error of every possible pair.
+    """
+    best = np.minimum(distances[:, :, None], distances[:, None, :])
+    return best.reshape(PALETTE_SIZE, PALETTE_SIZE * PALETTE_SIZE).astype(np.float64)
+
+
+def squash_blocks(blocks: np.ndarray, distances: np.ndarray, costs: np.ndarray = None) -> np.ndarray:
+    """
+    Reduce every block in `blocks` to (at most) two palette colors at once.
+
+    For each block, picks the pair of palette colors with the lowest total
+    squared error over its pixels, then maps each pixel to the closer of the two.
+    """
+    if costs is None:
+        costs = pair_costs(distances)
+
+    shape = blocks.shape
+    flat = blocks.reshape(-1, BLOCK_HEIGHT * BLOCK_WIDTH).astype(np.intp)
+    n = len(flat)
+
+    # per-block color histograms, in one bincount by offsetting each block
+    offsets = np.arange(n)[:, None] * PALETTE_SIZE
+    counts = np.bincount((flat + offsets).ravel(), minlength=n * PALETTE_SIZE)
+    counts = counts.reshape(n, PALETTE_SIZE)
+
+    # error of every color pair for every block, pick cheapest
+    best = (counts @ costs).argmin(axis=1)
+    a, b = np.divmod(best, PALETTE_SIZE)
+
+    # snap each pixel to whichever of the pair is closer
+    use_a = distances[flat, a[:, None]] <= distances[flat, b[:, None]]
+    squashed = np.where(use_a, a[:, None], b[:, None]).astype(np.uint8)
+
+    return squashed.reshape(shape)
+
+
+def block_deltas(prev: np.ndarray, next: np.ndarray) -> np.ndarray:
+    "count differing pixels per block, as a (rows, cols) matrix"
+    return np.count_nonzero(prev != next, axis=(-2, -1))
+
+
+def weighted_deltas(prev: np.ndarray, next: np.ndarray, weights: np.ndarray, spatial=0.0) -> np.ndarray:
+    """
+    Perceived size of the change from `prev` to `next` per block, as a (rows, cols) matrix.
+
+    Each pixel counts the `weights` distance between its old and new color,
+    to within 1/255. With `spatial`, pixels count up to that much more again
+    when all their neighbours in the block changed too, as clustered changes
+    (edges and shapes) stand out more than scattered ones.
+    """
+    # weights as bytes, so looking them up is a cheap byte translation
+    table = np.round(weights.ravel() * 255).astype(np.uint8)
+
+    differs = prev != next
+    block_size = prev.shape[-2] * prev.shape[-1]
+
+    if not spatial and np.count_nonzero(differs) <= differs.size // 32:
+        # mostly unchanged, so only look up the pixels that did change and add them up per block
+        changed = np.flatnonzero(differs)
+        pairs = (prev.ravel()[changed] << 4) | next.ravel()[changed]
+        deltas = np.bincount(
+            changed // block_size, weights=np.take(table, pairs), minlength=differs.size // block_size
+        )
+        return deltas.reshape(prev.shape[:-2]).astype(np.float32) / 255
+
+    # palette indices fit in 4 bits, so both index the table as one byte
+    pairs = (prev << 4) | next
+    pixels = np.frombuffer(pairs.tobytes().translate(table.tobytes()), dtype=np.uint8).reshape(pairs.shape)
+
+    if spatial:
+        # count changed neighbours above, below, left and right
+        changed = differs.view(np.uint8)
+        neighbours = np.zeros(changed.shape, dtype=np.uint8)
+        neighbours[..., 1:, :] += changed[..., :-1, :]
+        neighbours[..., :-1, :] += changed[..., 1:, :]
+        neighbours[..., :, 1:] += changed[..., :, :-1]
+        neighbours[..., :, :-1] += changed[..., :, 1:]
+        pixels = pixels * np.take(1 + spatial / 4 * np.arange(5, dtype=np.float32), neighbours)
+        return pixels.sum(axis=(-2, -1)) / 255
+
+    # a block of bytes adds up to less than 2**16
+    return pixels.sum(axis=(-2, -1), dtype=np.uint16) / np.float32(255)
+
+
+def shift_blocks(blocks: np.ndarray, dy: int, dx: int, fill=None) -> np.ndarray:
+    """
+    Move `blocks` by `dy` rows and `dx` cols, like the scroll instructions.
+
+    Blocks moved off one edge wrap around to the other, unless a `fill` color
+    is given for the newly exposed edges.
+    """
+    shifted = np.roll(blocks, (dy, dx), axis=(0, 1))
+
+    if fill is not None:
+        edge = lambda d: slice(None, d) if d > 0 else slice(d, None)
+        if dy:
+            shifted[edge(dy)] = fill
+        if dx:
+            shifted[:, edge(dx)] = fill
+
+    return shifted
+
+
+def best_shift(
+    screen: np.ndarray, next: np.ndarray, threshold=0, reach=1, weights: np.ndarray = None, spatial=0.0
+) -> tuple[int, int, int]:
+    """
+    Find whole-block shift of `screen` that best matches `next`.
+
+    Tries moving by up to `reach` blocks in each direction, shortest moves
+    first. Returns the (dy, dx) shift and how many fewer blocks would then
+    differ by more than `threshold`, counting newly exposed blocks as
+    differing. Differences are counted in pixels, or by `weighted_deltas()`
+    if palette `weights` are given.
+    """
+    rows, cols = screen.shape[:2]
+    if weights is None:
+        # pixels of a block in one axis, so counting them is a single reduction
+        screen = screen.reshape(rows, cols, -1)
+        next = next.reshape(rows, cols, -1)
+
+    def changed(dy, dx):
+        # compare only where the shifted screen overlaps, without copying it
+        moved = screen[max(0, -dy) : rows - max(0, dy), max(0, -dx) : cols - max(0, dx)]
+        target = next[max(0, dy) : rows - max(0, -dy), max(0, dx) : cols - max(0, -dx)]
+        if weights is None:
+            deltas = (moved != target).sum(axis=-1, dtype=np.uint8)
+        else:
+            deltas = weighted_deltas(moved, target, weights, spatial)
+        return int(np.count_nonzero(deltas > threshold)) + rows * cols - deltas.size
+
+    unshifted = changed(0, 0)
+    best = (0, 0, 0)
+
+    shifts = sorted(itertools.product(range(-reach, reach + 1), repeat=2), key=lambda s: max(map(abs, s)))
+    for dy, dx in shifts[1:]:
+        saving = unshifted - changed(dy, dx)
+        if saving > best[2]:
+            best = (dy, dx, saving)
+
+    return best
+
+
+def block_stability(current: np.ndarray, future: list[np.ndarray], threshold=0) -> np.ndarray:
+    """
+    Number of `future` frames each block of `current` stays (about) the same
+    for, before first changing by more than `threshold` pixels.
+    """
+    same = np.stack([block_deltas(current, f) <= threshold for f in future])
+    return np.cumprod(same, axis=0).sum(axis=0)
+
+
+def rank_blocks(priority: np.ndarray, k: int = None, threshold=0) -> np.ndarray:
+    """
+    Flat indices of blocks with `priority` above `threshold`, highest first.
+
+    If `k` is given, only the top `k` are selected (and sorted). Ties are
+    broken in row-major order.
+    """
+    flat = priority.ravel()
+    idx = np.flatnonzero(flat > threshold)
+
+    if k is not None and k < len(idx):
+        # only partially sort to find the kth largest value
+        values = flat[idx]
+        kth = -np.partition(-values, k - 1)[k - 1]
+        # take everything above it, then fill with the first tied blocks
+        above = idx[values > kth]
+        tied = idx[values == kth][: k - len(above)]
+        idx = np.concatenate((above, tied))
+
+    return idx[np.lexsort((idx, -flat[idx]))]
+
+
+class Updates:
+    "per-block changes for one frame, ranked by priority"
+
+    def __init__(self, priority: np.ndarray, blocks: np.ndarray, threshold=0) -> None:
+        # (rows, cols) matrix of block priorities
+        self.priority = priority
+        # (rows, cols, 12, 6) target block data
+        self.blocks = blocks
+        self.threshold = threshold
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(self.priority > self.threshold))
+
+    def _coords(self, idx: np.ndarray) -> list[tuple[int, int]]:
+        rows, cols = np.divmod(idx, self.priority.shape[1])
+        return list(zip(rows.tolist(), cols.tolist()))
+
+    def top_indices(self, k: int) -> tuple[np.ndarray, np.ndarray]:
+        "arrays of rows and cols of the `k` highest priority blocks"
+        return np.divmod(rank_blocks(self.priority, k, self.threshold), self.priority.shape[1])
+
+    def top(self, k: int) -> list[tuple[int, int]]:
+        "(row, col) of the `k` highest priority blocks"
+        return self._coords(rank_blocks(self.priority, k, self.threshold))
+
+    def ranked(self) -> list[tuple[int, int]]:
+        "(row, col) of every block above threshold, highest priority first"
+        return self._coords(rank_blocks(self.priority, None, self.threshold))
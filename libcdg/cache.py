@@ -0,0 +1,152 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from .constants import *
+
+"""
+On-disk cache for derived palettes and decoded frame streams.
+
+Entries are keyed by a hash of the source file contents plus the options that
+affect them, so repeat encodes of the same master can skip that work.
+"""
+
+DEFAULT_DIR = Path(os.environ.get("XDG_CACHE_HOME", "~/.cache")).expanduser() / "libcdg"
+DEFAULT_MAX_SIZE = 4 * 1024**3
+
+FRAME_BYTES = FULL_WIDTH * FULL_HEIGHT
+
+
+def file_digest(path: str | os.PathLike) -> str:
+    "hash of the contents of file at `path`"
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Cache:
+    log = logging.getLogger("libcdg.cache")
+
+    def __init__(self, directory: str | os.PathLike = DEFAULT_DIR, max_size=DEFAULT_MAX_SIZE) -> None:
+        "cache in `directory`, evicting least recently used entries above `max_size` bytes"
+        self.directory = Path(directory)
+        self.max_size = max_size
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def key(self, digest: str, **options) -> str:
+        "cache key for source with content `digest`, encoded with `options`"
+        opts = json.dumps(options, sort_keys=True, default=str)
+        return hashlib.blake2b(f"{digest}:{opts}".encode(), digest_size=16).hexdigest()
+
+    def _path(self, key: str, kind: str) -> Path:
+        return self.directory / f"{key}.{kind}"
+
+    def _hit(self, path: Path) -> Path | None:
+        if not path.exists():
+            return None
+        # mark as recently used for eviction
+        os.utime(path)
+        return path
+
+    def get_palette(self, key: str) -> list[tuple[int, int, int]] | None:
+        "cached palette for `key`, if any"
+        if path := self._hit(self._path(key, "palette.json")):
+            self.log.info(f"using cached palette {path.name}")
+            return [tuple(c) for c in json.loads(path.read_text())]
+        return None
+
+    def put_palette(self, key: str, palette: list[tuple[int, int, int]]):
+        self._path(key, "palette.json").write_text(json.dumps(palette))
+        self.evict()
+
+    def get_frames(self, key: str) -> np.ndarray | None:
+        "cached stream of palette-mapped frames for `key`, if any, as (N, height, width) array"
+        if path := self._hit(self._path(key, "frames")):
+            self.log.info(f"using cached frames {path.name}")
+            frames = np.memmap(path, dtype=np.uint8, mode="r")
+            return frames.reshape(-1, FULL_HEIGHT, FULL_WIDTH)
+        return None
+
+    def frame_writer(self, key: str) -> "FrameWriter":
+        "writer to store a stream of palette-mapped frames for `key`"
+        return FrameWriter(self, self._path(key, "frames"))
+
+    def _entries(self) -> list[Path]:
+        # frames still being written are not entries yet, and may be in use by another encode
+        return [f for f in self.directory.iterdir() if f.is_file() and f.suffix != ".partial"]
+
+    def size(self) -> int:
+        "total size of cache entries in bytes"
+        return sum(f.stat().st_size for f in self._entries())
+
+    def evict(self):
+        "remove least recently used entries until cache fits in `max_size`"
+        entries = sorted(self._entries(), key=lambda f: f.stat().st_mtime)
+        total = sum(f.stat().st_size for f in entries)
+
+        for entry in entries:
+            if total <= self.max_size:
+                break
+            self.log.debug(f"evicting {entry.name}")
+            total -= entry.stat().st_size
+            entry.unlink()
+
+    def clear(self):
+        "remove everything from the cache"
+        self.log.info(f"clearing cache at {self.directory}")
+        shutil.rmtree(self.directory)
+        self.directory.mkdir(parents=True)
+
+
+class FrameWriter:
+    """
+    appends frames to a temporary file, only added to the cache once complete
+
+    Streams that grow bigger than the whole cache are dropped as soon as they
+    do, rather than evicting everything else to make room.
+    """
+
+    def __init__(self, cache: Cache, path: Path) -> None:
+        self.cache = cache
+        self.path = path
+        # named uniquely, so encodes of the same frames at once do not write over each other
+        self.file = tempfile.NamedTemporaryFile(
+            dir=path.parent, prefix=f"{path.name}.", suffix=".partial", delete=False
+        )
+        self.partial = Path(self.file.name)
+        self.written = 0
+
+    def write(self, frame: np.ndarray):
+        assert frame.nbytes == FRAME_BYTES, "frame is the wrong size!"
+        if self.file.closed:
+            return
+
+        if self.written + FRAME_BYTES > self.cache.max_size:
+            self.cache.log.info(f"frames are too big for the cache, not storing {self.path.name}")
+            self.discard()
+            return
+
+        self.file.write(np.ascontiguousarray(frame).data)
+        self.written += FRAME_BYTES
+
+    def commit(self):
+        "finish writing, and add frames to cache"
+        if self.file.closed:
+            return
+        self.file.close()
+        self.partial.replace(self.path)
+        self.cache.evict()
+
+    def discard(self):
+        "finish writing, but throw away incomplete frames"
+        self.file.close()
+        self.partial.unlink(missing_ok=True)
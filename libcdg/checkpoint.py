@@ -0,0 +1,62 @@
+import json
+import os
+
+import numpy as np
+
+"""
+Snapshots of encoder state, so long encodes can pick up where they stopped.
+"""
+
+
+class Checkpoint:
+    """
+    Encoder state after `frame` frames, enough to carry on encoding from there.
+
+    `offset` is how many bytes of output came before it, `screen` and `age`
+    are the screen model and scheduler ages, and `palette` and `settings`
+    are checked so a checkpoint is only resumed by the same kind of encode.
+    """
+
+    def __init__(
+        self,
+        frame: int,
+        offset: int,
+        screen: np.ndarray,
+        age: np.ndarray,
+        palette: list[tuple[int, int, int]],
+        settings: dict,
+    ) -> None:
+        self.frame = frame
+        self.offset = offset
+        self.screen = screen
+        self.age = age
+        self.palette = [tuple(c) for c in palette]
+        self.settings = settings
+
+    def save(self, path: str | os.PathLike):
+        "write checkpoint to `path`, replacing any previous one in a single step"
+        partial = f"{path}.partial"
+        with open(partial, "wb") as f:
+            np.savez(
+                f,
+                frame=self.frame,
+                offset=self.offset,
+                screen=self.screen,
+                age=self.age,
+                palette=np.array(self.palette),
+                settings=json.dumps(self.settings, sort_keys=True),
+            )
+        os.replace(partial, path)
+
+    @classmethod
+    def load(cls, path: str | os.PathLike) -> "Checkpoint":
+        "read checkpoint saved to `path`"
+        with np.load(path) as data:
+            return cls(
+                frame=int(data["frame"]),
+                offset=int(data["offset"]),
+                screen=data["screen"],
+                age=data["age"],
+                palette=data["palette"].tolist(),
+                settings=json.loads(str(data["settings"])),
+            )
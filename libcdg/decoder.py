@@ -0,0 +1,205 @@
+import os
+from collections.abc import Iterator
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from .constants import *
+from .instructions import PACKET_DTYPE
+
+"""
+Decodes CD+G packets back into pixels, the way a player would.
+
+Useful for previewing what an encoded stream actually looks like, and for
+checking encoder fidelity.
+"""
+
+# inner visible area, inside the border
+DISPLAY_TOP, DISPLAY_LEFT = BLOCK_HEIGHT, BLOCK_WIDTH
+
+
+def unpack_color(hi: int, lo: int) -> tuple[int, int, int]:
+    "unpack RGB444 from the two color table bytes, xxRRRRGG xxGGBBBB"
+    return ((hi >> 2) & 0x0F, ((hi & 0x03) << 2) | ((lo >> 4) & 0x03), lo & 0x0F)
+
+
+class Decoder:
+    "Interprets CD+G packets into a 300x216 framebuffer of palette indices"
+
+    def __init__(self) -> None:
+        self.screen = np.zeros((FULL_HEIGHT, FULL_WIDTH), dtype=np.uint8)
+        # palette in RGB24
+        self.colors = np.zeros((PALETTE_SIZE, 3), dtype=np.uint8)
+        self.transparent = None
+
+        # fine scroll offset of the visible area, in pixels
+        self.h_offset = 0
+        self.v_offset = 0
+
+        self.packets_read = 0
+
+        self._handlers = {
+            INST_PRESET_MEMORY: self._preset_memory,
+            INST_PRESET_BORDER: self._preset_border,
+            INST_WRITE_FONT_BLOCK: self._write_font_block,
+            INST_XOR_FONT_BLOCK: self._xor_font_block,
+            INST_SCROLL_PRESET: self._scroll_preset,
+            INST_SCROLL_COPY: self._scroll_copy,
+            INST_DEFINE_TRANSP_COLOR: self._define_transparent,
+            INST_LOAD_COLOR_TABLE_LOW: self._load_color_table_low,
+            INST_LOAD_COLOR_TABLE_HIGH: self._load_color_table_high,
+        }
+
+    def feed(self, packets: bytes | np.ndarray):
+        "apply a run of whole packets to the screen"
+        if isinstance(packets, (bytes, bytearray, memoryview)):
+            packets = np.frombuffer(packets, dtype=PACKET_DTYPE)
+        self.packets_read += len(packets)
+
+        # only the lower 6 bits of each byte are used
+        commands = packets["command"] & 0x3F
+        instructions = packets["instruction"] & 0x3F
+        data = packets["data"] & 0x3F
+
+        # skip nops and anything that isnt graphics
+        for i in np.flatnonzero(commands == CDG_COMMAND_MAGIC_BYTE):
+            handler = self._handlers.get(int(instructions[i]))
+            if handler:
+                handler(data[i])
+
+    def render(self) -> np.ndarray:
+        "current screen as a (height, width, 3) RGB array"
+        screen = self.screen
+
+        # visible area is shifted by the fine scroll offsets
+        if self.h_offset or self.v_offset:
+            screen = screen.copy()
+            top, left = DISPLAY_TOP + self.v_offset, DISPLAY_LEFT + self.h_offset
+            screen[
+                DISPLAY_TOP : DISPLAY_TOP + DISPLAY_HEIGHT, DISPLAY_LEFT : DISPLAY_LEFT + DISPLAY_WIDTH
+            ] = self.screen[top : top + DISPLAY_HEIGHT, left : left + DISPLAY_WIDTH]
+
+        return np.take(self.colors, screen, axis=0)
+
+    # === instructions ===
+
+    def _preset_memory(self, data):
+        self.screen[:] = data[0] & 0x0F
+
+    def _preset_border(self, data):
+        color = data[0] & 0x0F
+        self.screen[:DISPLAY_TOP] = color
+        self.screen[DISPLAY_TOP + DISPLAY_HEIGHT :] = color
+        self.screen[:, :DISPLAY_LEFT] = color
+        self.screen[:, DISPLAY_LEFT + DISPLAY_WIDTH :] = color
+
+    def _font_block(self, data) -> tuple[tuple[slice, slice], np.ndarray] | None:
+        "target area and pixels of a font block instruction"
+        row, col = int(data[2] & 0x1F), int(data[3] & 0x3F)
+        if row >= FULL_HEIGHT_BLOCKS or col >= FULL_WIDTH_BLOCKS:
+            return None
+
+        # pixels are the lower 6 bits of the 12 row bytes
+        bits = np.unpackbits(data[4:16, None], axis=1)[:, 8 - BLOCK_WIDTH :].astype(bool)
+        pixels = np.where(bits, data[1] & 0x0F, data[0] & 0x0F).astype(np.uint8)
+
+        area = (
+            slice(row * BLOCK_HEIGHT, (row + 1) * BLOCK_HEIGHT),
+            slice(col * BLOCK_WIDTH, (col + 1) * BLOCK_WIDTH),
+        )
+        return area, pixels
+
+    def _write_font_block(self, data):
+        if block := self._font_block(data):
+            area, pixels = block
+            self.screen[area] = pixels
+
+    def _xor_font_block(self, data):
+        if block := self._font_block(data):
+            area, pixels = block
+            self.screen[area] ^= pixels
+
+    def _scroll(self, data, fill: int | None):
+        h_scroll, v_scroll = int(data[1]), int(data[2])
+        h_cmd, self.h_offset = (h_scroll & 0x30) >> 4, min(h_scroll & 0x07, BLOCK_WIDTH - 1)
+        v_cmd, self.v_offset = (v_scroll & 0x30) >> 4, min(v_scroll & 0x0F, BLOCK_HEIGHT - 1)
+
+        # 1 is right/down by a block, 2 is left/up
+        dx = {1: BLOCK_WIDTH, 2: -BLOCK_WIDTH}.get(h_cmd, 0)
+        dy = {1: BLOCK_HEIGHT, 2: -BLOCK_HEIGHT}.get(v_cmd, 0)
+        if not dx and not dy:
+            return
+
+        self.screen = np.roll(self.screen, (dy, dx), axis=(0, 1))
+
+        # preset fills in the exposed edges, copy wraps them around
+        if fill is not None:
+            if dy > 0:
+                self.screen[:dy] = fill
+            elif dy < 0:
+                self.screen[dy:] = fill
+            if dx > 0:
+                self.screen[:, :dx] = fill
+            elif dx < 0:
+                self.screen[:, dx:] = fill
+
+    def _scroll_preset(self, data):
+        self._scroll(data, int(data[0] & 0x0F))
+
+    def _scroll_copy(self, data):
+        self._scroll(data, None)
+
+    def _define_transparent(self, data):
+        # no compositing here, just keep track of it
+        self.transparent = data.copy()
+
+    def _load_colors(self, data, start: int):
+        for i in range(8):
+            levels = unpack_color(int(data[2 * i]), int(data[2 * i + 1]))
+            self.colors[start + i] = np.array(levels) * 17
+
+    def _load_color_table_low(self, data):
+        self._load_colors(data, 0)
+
+    def _load_color_table_high(self, data):
+        self._load_colors(data, 8)
+
+
+def read_packets(path: str | os.PathLike) -> np.ndarray:
+    "map .cdg file at `path` as array of packets"
+    return np.memmap(path, dtype=PACKET_DTYPE, mode="r")
+
+
+def decode(packets: bytes | np.ndarray, frame_rate=15) -> Iterator[np.ndarray]:
+    "decode stream of `packets`, yielding an RGB frame every 1/`frame_rate` seconds"
+    if isinstance(packets, (bytes, bytearray, memoryview)):
+        packets = np.frombuffer(packets, dtype=PACKET_DTYPE)
+
+    per_frame = PACKETS_PER_SECOND // frame_rate
+    decoder = Decoder()
+
+    for start in range(0, len(packets), per_frame):
+        decoder.feed(packets[start : start + per_frame])
+        yield decoder.render()
+
+
+def render(cdg_path: str | os.PathLike, output: str | os.PathLike, frame_rate=15, images=False) -> int:
+    """
+    Decode .cdg file at `cdg_path` to raw RGB24 frames in file `output`, or
+    into a directory of numbered PNG `images`. Returns the number of frames.
+    """
+    frames = decode(read_packets(cdg_path), frame_rate)
+    count = 0
+
+    if images:
+        output = Path(output)
+        output.mkdir(parents=True, exist_ok=True)
+        for count, frame in enumerate(frames, start=1):
+            Image.fromarray(frame).save(output / f"{count:06d}.png")
+    else:
+        with open(output, "wb") as out:
+            for count, frame in enumerate(frames, start=1):
+                out.write(frame.tobytes())
+
+    return count
@@ -1,6 +1,9 @@
+import collections
 import functools
 import itertools
+import queue
 import random
+import threading
 from math import floor
 
 from PIL import Image, ImageOps
@@ -27,11 +30,129 @@ def groups_of(it: iter, n: int) -> iter:
     return iter(lambda: list(itertools.islice(it, n)), [])
 
 
+def lookahead(it: iter, n: int) -> iter:
+    "yield each item of iterable `it` along with a list of up to `n` items after it"
+    window = collections.deque()
+    for item in it:
+        window.append(item)
+        if len(window) > n:
+            yield window.popleft(), list(window)
+    while window:
+        yield window.popleft(), list(window)
+
+
+async def alookahead(it, n: int):
+    "async version of `lookahead()`, over async iterable `it`"
+    window = collections.deque()
+    async for item in it:
+        window.append(item)
+        if len(window) > n:
+            yield window.popleft(), list(window)
+    while window:
+        yield window.popleft(), list(window)
+
+
+def threaded(it: iter, maxsize: int) -> iter:
+    """
+    Run iterable `it` in a background thread, up to `maxsize` items ahead.
+
+    Items come out in the same order, and errors are re-raised in the
+    consuming thread. Stopping early also stops the background thread.
+    """
+    items = queue.Queue(maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def put(item) -> bool:
+        # give up if the consumer went away, rather than block forever
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run():
+        source = iter(it)
+        try:
+            for item in source:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except BaseException as e:
+            put((done, e))
+        finally:
+            if hasattr(source, "close"):
+                source.close()
+
+    thread = threading.Thread(target=run, name="libcdg-reader", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class ThreadedWriter:
+    "writes to file-like `sink` from a background thread, with up to `maxsize` writes pending"
+
+    def __init__(self, sink, maxsize: int) -> None:
+        self.sink = sink
+        self.pending = queue.Queue(maxsize)
+        self.error = None
+
+        self.thread = threading.Thread(target=self._run, name="libcdg-writer", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while (data := self.pending.get()) is not None:
+            # keep draining after an error, so writers never block
+            if self.error is None:
+                try:
+                    data() if callable(data) else self.sink.write(data)
+                except BaseException as e:
+                    self.error = e
+
+    def write(self, data: bytes):
+        "queue `data` to be written, it must not be changed afterwards"
+        if self.error:
+            raise self.error
+        self.pending.put(data)
+
+    def call(self, fn):
+        "run `fn` in the writer thread, once the writes queued before it are done"
+        if self.error:
+            raise self.error
+        self.pending.put(fn)
+
+    def close(self):
+        "wait for pending writes to finish, raising any error from them"
+        self.pending.put(None)
+        self.thread.join()
+        if self.error:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
 def rgb_to_444(color: tuple[int]):
-    "convert `color` triplet in RGB24 (0-255) to RBG444 (0-16)"
+    "convert `color` triplet in RGB24 (0-255) to RBG444 (0-15)"
     r, g, b = color
-    rf = lambda c: min(round(c), 15)  # rf = round or floor at 16
-    return (rf(r / 16), rf(g / 16), rf(b / 16))
+    # scale to nearest level, so 0x11 steps map back exactly
+    rf = lambda c: round(c * 15 / 255)
+    return (rf(r), rf(g), rf(b))
 
 
 def show(img):
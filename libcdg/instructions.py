@@ -1,5 +1,7 @@
 from struct import pack
 
+import numpy as np
+
 from .constants import *
 
 # todo: handle masking? check int sizes?
@@ -28,6 +30,34 @@ def _packet(instruction, data):
     )
 
 
+# layout of a whole packet, for building many packets at once
+PACKET_DTYPE = np.dtype(
+    [
+        ("command", "u1"),
+        ("instruction", "u1"),
+        ("parity_q", "u1", 2),
+        ("data", "u1", DATA_SIZE),
+        ("parity_p", "u1", 4),
+    ]
+)
+assert PACKET_DTYPE.itemsize == PACKET_SIZE
+
+
+def packet_buffer(count: int) -> np.ndarray:
+    "preallocate structured array of `count` packets, initially all nop"
+    return np.zeros(count, dtype=PACKET_DTYPE)
+
+
+def as_record(packet: bytes) -> np.ndarray:
+    "view single packet as a record, for storing in a packet buffer"
+    return np.frombuffer(packet, dtype=PACKET_DTYPE)[0]
+
+
+def scroll_command(blocks: int) -> int:
+    "scroll command bits for moving by -1 (left/up), 0, or 1 (right/down) blocks"
+    return {0: 0, 1: 1, -1: 2}[blocks] << 4
+
+
 def nop():
     return pack(f">{PACKET_SIZE}x")
 
@@ -64,6 +94,40 @@ def xor_font_block(bg_color, fg_color, row, column, pixels, channel=0):
     )
 
 
+def font_blocks(rows, columns, bg_colors, fg_colors, bitmaps, xor=False, validate=False, out=None):
+    """
+    Batch version of `write_font_block`/`xor_font_block`.
+
+    Takes arrays of N rows, columns, and colors, plus an (N, 12, 6) array of
+    `bitmaps` that are true where the foreground color is drawn. Packets are
+    filled into `out` (or a new packet buffer) in one pass, and returned as a
+    memoryview of it without copying.
+    """
+    rows, columns = np.asarray(rows), np.asarray(columns)
+    bg_colors, fg_colors = np.asarray(bg_colors), np.asarray(fg_colors)
+
+    if validate:
+        assert (bg_colors <= 0x0F).all() and (fg_colors <= 0x0F).all()
+        assert (rows <= 0x1F).all() and (columns <= 0x3F).all()
+        assert np.shape(bitmaps)[1:] == (BLOCK_HEIGHT, BLOCK_WIDTH)
+
+    if out is None:
+        out = packet_buffer(len(rows))
+
+    out["command"] = CDG_COMMAND_MAGIC_BYTE
+    out["instruction"] = INST_XOR_FONT_BLOCK if xor else INST_WRITE_FONT_BLOCK
+
+    data = out["data"]
+    data[:, 0] = bg_colors
+    data[:, 1] = fg_colors
+    data[:, 2] = rows
+    data[:, 3] = columns
+    # pack pixel rows into the lower 6 bits of each byte
+    data[:, 4:] = np.packbits(np.asarray(bitmaps, dtype=bool), axis=-1)[..., 0] >> 2
+
+    return out.data
+
+
 def scroll_preset(color, h_scroll, v_scroll):
     assert color <= 0x0F
     assert h_scroll <= 0x3F and v_scroll <= 0x3F
@@ -74,7 +138,7 @@ def scroll_preset(color, h_scroll, v_scroll):
 def scroll_copy(h_scroll, v_scroll):
     assert h_scroll <= 0x3F and v_scroll <= 0x3F
 
-    return _packet(INST_SCROLL_PRESET, pack(">xBB13x", h_scroll, v_scroll))
+    return _packet(INST_SCROLL_COPY, pack(">xBB13x", h_scroll, v_scroll))
 
 
 def set_transparency_color(alpha_levels):
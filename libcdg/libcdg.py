@@ -1,79 +1,221 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
 import itertools
 import logging
+import math
 import os
-import queue
-import subprocess
 import sys
 import tempfile
+from collections.abc import AsyncIterator, Callable, Iterator
+from types import SimpleNamespace
+from typing import BinaryIO
 
 import ffmpeg
 import numpy as np
 from PIL import Image
 
 from . import instructions
+from .audio import AudioExport
+from .blocks import (
+    Updates,
+    best_shift,
+    block_deltas,
+    block_stability,
+    color_weights,
+    pair_costs,
+    palette_distances,
+    shift_blocks,
+    squash_blocks,
+    to_blocks,
+    weighted_deltas,
+)
+from .cache import Cache, file_digest
+from .checkpoint import Checkpoint
 from .constants import *
-from .helpers import groups_of, rgb_to_444, set_palette
+from .decoder import Decoder, read_packets
+from .helpers import ThreadedWriter, alookahead, groups_of, lookahead, rgb_to_444, set_palette, threaded
+from .live import LIVE_LATENCY, PacedWriter
+from .palette import PaletteMapper, kmeans_444, write_palette_image
+from .scenes import CUT_THRESHOLD, DOMINANT_SHARE, Scene, SceneTracker
+from .scheduler import Scheduler
+from .sources import RING_SIZE, FFmpegSource, FrameSource
+from .stats import EncodeStats
 from .types import Block, DisplayFrame, FullFrame
 
 
+# write streamed output in chunks of this many bytes
+CHUNK_SIZE = 1024 * PACKET_SIZE
+
+# frames (or chunks) each pipeline stage can get ahead of the next
+PIPELINE_DEPTH = 4
+
+# palette tables, preset memory and border, before the first frame
+HEADER_PACKETS = 4
+
+# save a checkpoint every this many frames (a minute) when checkpointing
+CHECKPOINT_FRAMES = 15 * 60
+
+# furthest to scroll the screen in one frame, in blocks, each block moved costs a packet
+MAX_SCROLL = 3
+
+# frames a re-encoded range can run over to match back up with the original
+SETTLE_FRAMES = 15 * 10
+
+# called with frames done and total frames (if known) during async encodes
+ProgressCallback = Callable[[int, int | None], None]
+
+
 class Video:
     FRAME_RATE = 15
     PACKETS_PER_FRAME = PACKETS_PER_SECOND // FRAME_RATE
 
+    # cells need more than this many pixels changed to be tracked
+    PIXEL_THRESHOLD = 4
+    # or this much perceived change, in black to white pixels. Each pixel's
+    # change is rounded to 1/255 of that, so colors closer than 1/510 apart
+    # count as no change at all, and finer thresholds make no difference
+    PERCEPTUAL_THRESHOLD = 1.0
+
     log = logging.getLogger("libcdg")
     log.setLevel("DEBUG")
 
     def __init__(
         self,
-        source: str | os.PathLike,
+        source: str | os.PathLike | FrameSource,
         mono=False,
-        palette: str | os.PathLike = None,
+        palette: str | os.PathLike | list[tuple[int, int, int]] = None,
         quiet=True,
         fill_frame=False,
+        squash="numpy",
+        monitor: str | os.PathLike = None,
+        palette_method="uniform",
+        palette_samples=64,
+        cache: Cache = None,
+        cache_frames=False,
+        aging=0.25,
+        lookahead=0,
+        scroll=False,
+        pipeline=False,
+        audio_format="mp3",
+        audio_bitrate: str = None,
+        audio_copy=False,
+        scenes: str = None,
+        cut_threshold=CUT_THRESHOLD,
+        priority="pixels",
+        threshold: float = None,
+        spatial=0.0,
     ) -> None:
         """ """
 
-        self.source = str(source)
+        assert squash in ["numpy", "pil"], f"unknown squash engine {squash}!"
+        assert palette_method in [
+            "uniform",
+            "scene",
+            "palettegen",
+        ], f"unknown palette method {palette_method}!"
+        assert scenes in [None, "cuts", "palettes"], f"unknown scene mode {scenes}!"
+        assert priority in ["pixels", "perceptual"], f"unknown priority metric {priority}!"
+
         self.mono = mono
         self.quiet = quiet
 
         self.current_frame = 0
         self.packets: list[bytes] = []
+        # count of packets written out to a sink, when streaming
+        self.packets_written = 0
+        # timings and counters of the last encode
+        self.stats: EncodeStats | None = None
 
         self.fill_frame = fill_frame
+        self.squash = squash
+        # how quickly waiting updates gain priority
+        self.aging = aging
+        # frames to look ahead for blocks that are about to change again
+        self.lookahead = lookahead
+        # use scroll instructions for whole-screen motion, up to MAX_SCROLL blocks a frame
+        self.scroll = scroll
+        # overlap decoding and writing with analysis in threads
+        self.pipeline = pipeline
+        # detect hard cuts, and optionally switch palette at each
+        self.scenes = scenes
+        self.cut_threshold = cut_threshold
+        # rank changed blocks by pixel count, or by how different the colors look
+        self.priority = priority
+        if threshold is None:
+            threshold = self.PIXEL_THRESHOLD if priority == "pixels" else self.PERCEPTUAL_THRESHOLD
+        self.threshold = threshold
+        # extra weight for changed pixels next to other changes, perceptual only
+        self.spatial = spatial
+        # optional preview of the palette-mapped input
+        self.monitor = str(monitor) if monitor else None
+
+        # anything else is a file for ffmpeg to decode
+        if not isinstance(source, FrameSource):
+            source = FFmpegSource(
+                source,
+                frame_rate=self.FRAME_RATE,
+                fill_frame=fill_frame,
+                mono=mono,
+                monitor=monitor,
+                quiet=quiet,
+            )
+        elif monitor:
+            self.log.warning("monitor output is only written for ffmpeg sources!")
+        self.source = source
+
+        # audio track, extracted alongside the encode
+        self.audio = None
+        if source.audio is not None:
+            self.audio = AudioExport(
+                source.audio, format=audio_format, bitrate=audio_bitrate, copy=audio_copy, quiet=quiet
+            )
 
-        # calculate palette here at init
-        self.palette = self.calc_palette(palette)
-
-    def ff_scale_input(self):
-        "shared scale input video scale ffmpeg pipeline"
+        # optional on-disk cache of palette and decoded frames
+        self.cache = cache
+        self.cache_frames = cache_frames
 
-        # create scale pipeline
-        ppl = (
-            ffmpeg.input(self.source)
-            # ensure 30fps to better match packet rate
-            .filter("fps", fps=self.FRAME_RATE)
+        # calculate palette here at init
+        self.palette_method = palette_method
+        self.palette_samples = palette_samples
+        self.palette = self.load_palette(palette)
+
+        # color distance lookups for block squashing
+        self.distances = palette_distances(self.palette)
+        self.pair_costs = pair_costs(self.distances)
+        # and for perceptual block priority
+        self.weights = color_weights(self.palette)
+
+    def source_digest(self) -> str | None:
+        "hash of source contents for cache keys, if it can be cached"
+        return self.source.digest()
+
+    def load_palette(self, palette_img) -> list[tuple[int, int, int]]:
+        "Fetch target palette from cache if possible, otherwise calculate it"
+
+        if not self.cache or self.mono or isinstance(palette_img, list) or self.source_digest() is None:
+            return self.calc_palette(palette_img)
+
+        key = self.cache.key(
+            self.source_digest(),
+            palette=file_digest(palette_img) if palette_img else None,
+            method=self.palette_method,
+            samples=self.palette_samples,
+            fill_frame=self.fill_frame,
+            fps=self.FRAME_RATE,
         )
 
-        # scale to CDG canvas size (either display or full)
-        if self.fill_frame:
-            ppl = ppl.filter("scale", width=FULL_WIDTH, height=FULL_HEIGHT, flags="neighbor")
+        palette = self.cache.get_palette(key)
+        if palette is None:
+            palette = self.calc_palette(palette_img)
+            self.cache.put_palette(key, palette)
         else:
-            ppl = (
-                ppl.filter("scale", width=DISPLAY_WIDTH, height=DISPLAY_HEIGHT, flags="neighbor")
-                # still pad back up to full size so it is centered
-                .filter("pad", width=FULL_WIDTH, height=FULL_HEIGHT, x=-1, y=-1)
-            )
-
-        if self.mono:  # force 1-bit black/white (a la Bad Apple)
-            dim = f"s={FULL_WIDTH}x{FULL_HEIGHT}"
-            black = ffmpeg.input(f"color=Black:{dim}", f="lavfi")
-            white = ffmpeg.input(f"color=White:{dim}", f="lavfi")
-            gray = ffmpeg.input(f"color=DarkGray:{dim}", f="lavfi")
-
-            ppl = ffmpeg.filter([ppl, gray, black, white], "threshold")
+            # still need palette file for ffmpeg
+            self.palette_file = tempfile.NamedTemporaryFile(prefix="libcdg_pallette_", suffix=".png")
+            write_palette_image(palette, self.palette_file.name)
 
-        return ppl
+        return palette
 
     def calc_palette(self, palette_img) -> list[tuple[int, int, int]]:
         "Calculate target palette based on input, or from given image"
@@ -94,12 +236,29 @@ class Video:
 
             # save palette to tempfile for later ffmpeg
             self.palette_file = tempfile.NamedTemporaryFile(
-                prefix="libcdg_pallette_", suffix=".png", delete=False
+                prefix="libcdg_pallette_", suffix=".png"
             )
             img.save(self.palette_file.name)
 
             return palette
 
+        elif isinstance(palette_img, list):
+            # colors given outright, such as for generator sources that cannot be sampled
+            assert 0 < len(palette_img) <= PALETTE_SIZE, f"palette should have 1 to {PALETTE_SIZE} colors, got {len(palette_img)}!"
+            palette = [tuple(int(c) for c in rgb) for rgb in palette_img]
+            assert all(
+                len(rgb) == 3 and all(0 <= c <= 255 for c in rgb) for rgb in palette
+            ), "palette colors should be (r, g, b) tuples of 0-255!"
+            self.log.info(f"using {len(palette)} given palette colors")
+
+            # save palette to tempfile for later ffmpeg
+            self.palette_file = tempfile.NamedTemporaryFile(
+                prefix="libcdg_pallette_", suffix=".png"
+            )
+            write_palette_image(palette, self.palette_file.name)
+
+            return palette
+
         else:
             if palette_img:
                 self.log.info(f"using palette from {palette_img}")
@@ -112,27 +271,49 @@ class Video:
                 # (ffmpeg wants specific size later so let it generate for itself)
                 palette_input = ffmpeg.input(palette_img)
 
-            else:
+            elif self.palette_method != "palettegen" or not isinstance(self.source, FFmpegSource):
+                # estimate from a sample of frames instead of a full decode
+                self.log.info(f"sampling {self.palette_samples} frames for palette")
+                try:
+                    frames = self.source.sample(self.palette_samples, self.palette_method)
+                    assert len(frames) > 0, "no frames sampled!"
+                except (ffmpeg.Error, AssertionError, KeyError) as e:
+                    # palettegen needs a file to decode
+                    if not isinstance(self.source, FFmpegSource):
+                        raise
+                    self.log.warning(f"could not sample frames ({e}), falling back to palettegen")
+                else:
+                    palette = kmeans_444(frames)
+
+                    # save palette to tempfile for later ffmpeg
+                    self.palette_file = tempfile.NamedTemporaryFile(
+                        prefix="libcdg_pallette_", suffix=".png"
+                    )
+                    write_palette_image(palette, self.palette_file.name)
+
+                    return palette
+
+            if not palette_img:
                 self.log.info(f"deriving palette from input video")
                 # no image, calculate from source
-                palette_input = ffmpeg.input(self.source)
+                palette_input = ffmpeg.input(self.source.path)
 
-                # crunch source vid or palette image to 16 colors (for global palette)
-                palettegen = palette_input.filter(
-                    "palettegen", max_colors=16, reserve_transparent=0
-                )
-                # TODO remove the other 256-16 colors from output png?
+            # crunch source vid or palette image to 16 colors (for global palette)
+            palettegen = palette_input.filter(
+                "palettegen", max_colors=16, reserve_transparent=0
+            )
+            # TODO remove the other 256-16 colors from output png?
 
-                # save palette to tempfile for later use
-                self.palette_file = tempfile.NamedTemporaryFile(
-                    prefix="libcdg_pallette_", suffix=".png"
-                )
-                (
-                    palettegen.output(self.palette_file.name, vframes=1)
-                    .global_args("-hide_banner")
-                    .overwrite_output()
-                    .run(quiet=self.quiet)
-                )
+            # save palette to tempfile for later use
+            self.palette_file = tempfile.NamedTemporaryFile(
+                prefix="libcdg_pallette_", suffix=".png"
+            )
+            (
+                palettegen.output(self.palette_file.name, vframes=1)
+                .global_args("-hide_banner")
+                .overwrite_output()
+                .run(quiet=self.quiet)
+            )
 
             with Image.open(self.palette_file) as palimg:
                 palimg = palimg.convert("P")
@@ -144,204 +325,856 @@ class Video:
                 assert len(palette) <= 16, f"too many colors in palette image! (got {len(palette)})"
                 return palette
 
-    def start_ffmpeg(self) -> subprocess.Popen:
-        "Captures output frames from ffmpeg over pipe"
+    def frame_count(self) -> int:
+        "number of frames the source will produce at FRAME_RATE, if known"
+        if self.cache and self.cache_frames and self.source_digest():
+            if (cached := self.cache.get_frames(self.frames_key())) is not None:
+                return len(cached)
 
-        # from palette gen
-        palette = ffmpeg.input(filename=self.palette_file.name)
+        return self.source.frame_count()
 
-        # write out monitor file
-        (
-            ffmpeg.filter([self.ff_scale_input(), palette], "paletteuse")
-            .output(self.source + "_monitor.mp4")
-            .global_args("-hide_banner", "-loglevel", "warning")
-            .run()
-        )
+    def iter_packets(self, start_frame=0, frame_count=None, resume: Checkpoint = None) -> Iterator[bytes]:
+        """
+        Encode frames, yielding the stream header and then each frame's packets as one chunk.
 
-        ffprocess = (
-            ffmpeg.filter([self.ff_scale_input(), palette], "paletteuse")
-            .output("pipe:", format="rawvideo", pix_fmt="rgb24")
-            .global_args("-hide_banner", "-loglevel", "warning")
-            .run_async(pipe_stdout=True)
-        )
+        If `start_frame` is given, only encodes the segment of `frame_count`
+        frames from there onwards. Segments have no header, and instead clear
+        the screen on their first frame so they start from a known state.
+
+        To carry on from a checkpoint instead, give it as `resume`.
+        """
+
+        if resume:
+            self.resume_encode(resume)
+            start_frame = resume.frame
+        elif header := self.start_encode(start_frame):
+            yield header
 
-        return ffprocess
+        frames = self.iter_blocks(start_frame, frame_count)
+        if self.pipeline:
+            # decode and squash ahead in the background, with times going to the frame they were spent on
+            frames = self.stats.consume(threaded(self.stats.produce(frames), PIPELINE_DEPTH))
 
-    def encode(self):
-        "Encode frames"
+        for next_blocks, future in lookahead(frames, self.lookahead):
+            yield self.encode_frame(next_blocks, future)
+
+        if padding := self.segment_padding(start_frame, frame_count):
+            yield padding
+
+    def start_encode(self, start_frame=0) -> bytes:
+        "Reset encoder state to start encoding at `start_frame`, returns the stream header if any"
 
         self.log.info("starting encode...")
 
-        FRAME_SIZE = FULL_WIDTH * FULL_HEIGHT * 3
+        self.current_frame = self.segment_start = start_frame
+        self.stats = EncodeStats(self.PACKETS_PER_FRAME)
+
+        # model of what the decoder is showing, as blocks
+        self.screen = np.zeros(
+            (FULL_HEIGHT_BLOCKS, FULL_WIDTH_BLOCKS, BLOCK_HEIGHT, BLOCK_WIDTH), dtype=np.uint8
+        )
+
+        # carries unsent updates between frames
+        self.scheduler = Scheduler(self.screen.shape[:2], aging=self.aging)
+
+        # reused for every frame's packets
+        self.frame_buffer = instructions.packet_buffer(self.PACKETS_PER_FRAME)
+
+        # scenes by the frame they start at, as found while decoding
+        self.scene_starts: dict[int, Scene] = {}
+        # perceptual weights for the palette on screen
+        self.scene_weights = self.weights
+
+        if start_frame != 0:
+            return b""
 
         # set palette first
-        self.packets += set_palette(self.palette)
+        header = list(set_palette(list(self.palette)))
 
         # set initial fg/bg
         # set canvas and border color
-        self.packets += [instructions.preset_memory(0), instructions.preset_border(1)]
-
-        # blank initial frame to match fill above
-        prev = Image.new("P", (FULL_WIDTH, FULL_HEIGHT), 0)
-        prev.putpalette(itertools.chain(*self.palette))
-
-        with self.start_ffmpeg() as ffpipe:
-            # get next frame from ffmpeg subprocess until exhausted
-            while len(framebytes := ffpipe.stdout.read(FRAME_SIZE)) > 0:
-                self.current_frame += 1
-                self.log.debug(f"frame #{self.current_frame} ")
-
-                frame = Image.frombytes("RGB", (FULL_WIDTH, FULL_HEIGHT), framebytes)
-                # should already be using this palette but make sure
-                frame = frame.quantize(palette=prev, dither=Image.Dither.NONE)
-
-                # get blocks to update
-                deltas = self.calc_updates(frame, prev)
-                frame_packets = []
-
-                # fetch the first however-many frames we can fit this round
-                updates_this_frame = list(deltas.queue)[: self.PACKETS_PER_FRAME]
-                for _pri, row, col, data in updates_this_frame:
-                    # write out instruction packet
-                    frame_packets.append(self.write_block(data, row, col))
-                    # and update prev frame with changes
-                    change = Image.fromarray(data, mode="P")
-                    prev.paste(change, (col * BLOCK_WIDTH, row * BLOCK_HEIGHT))
-
-                # self.log.trace(f"processed {len(frame_packets)} packets")
-
-                # pad out if we need to
-                if len(frame_packets) < self.PACKETS_PER_FRAME:
-                    # self.log.trace(f"padding extra {self.PACKETS_PER_FRAME - len(frame_packets)}")
-
-                    frame_packets += [instructions.nop()] * (
-                        self.PACKETS_PER_FRAME - len(frame_packets)
-                    )
+        header += [instructions.preset_memory(0), instructions.preset_border(1)]
+        self.stats.packets += len(header)
+
+        # match screen model, border is the outer ring of blocks
+        self.screen[[0, -1], :] = 1
+        self.screen[:, [0, -1]] = 1
+
+        return b"".join(header)
+
+    def resume_encode(self, checkpoint: Checkpoint):
+        "Restore encoder state from `checkpoint`, to carry on encoding after its frame"
+        assert checkpoint.palette == [tuple(c) for c in self.palette], "checkpoint uses a different palette!"
+        assert checkpoint.settings == self.settings(), "checkpoint was made with different settings!"
+
+        self.start_encode(checkpoint.frame)
+        self.log.info(f"resuming at frame {checkpoint.frame}")
+
+        # screen is known, so this is not a segment to clear
+        self.segment_start = 0
+        self.screen[:] = checkpoint.screen
+        self.scheduler.age[:] = checkpoint.age
+
+    def checkpoint(self) -> Checkpoint:
+        "Snapshot of encoder state after the current frame"
+        return Checkpoint(
+            frame=self.current_frame,
+            offset=self.packets_written * PACKET_SIZE,
+            screen=self.screen.copy(),
+            age=self.scheduler.age.copy(),
+            palette=self.palette,
+            settings=self.settings(),
+        )
 
-                assert (
-                    len(frame_packets) == self.PACKETS_PER_FRAME
-                ), f"{len(frame_packets)} is more than {self.PACKETS_PER_FRAME}!"
+    def settings(self) -> dict:
+        "options that change the encoded output, other than the palette"
+        return {
+            "mono": self.mono,
+            "fill_frame": self.fill_frame,
+            "squash": self.squash,
+            "aging": self.aging,
+            "lookahead": self.lookahead,
+            "scroll": self.scroll,
+            "scenes": self.scenes,
+            "cut_threshold": self.cut_threshold,
+            "priority": self.priority,
+            "threshold": self.threshold,
+            "spatial": self.spatial,
+            "fps": self.FRAME_RATE,
+        }
+
+    def encode_frame(self, next_blocks: FullFrame, future: list[FullFrame] = None) -> bytes:
+        "Encode the next frame of squashed blocks into a frame of packets, with `future` frames for lookahead"
+
+        stats = self.stats
+        frame_buffer = self.frame_buffer
+
+        self.current_frame += 1
+        self.log.debug(f"frame #{self.current_frame} ")
+
+        frame_buffer[:] = 0
+        budget = self.PACKETS_PER_FRAME
+
+        # segment does not know what is on screen before it
+        preset = self.current_frame == self.segment_start + 1 and self.segment_start != 0
+
+        if scene := self.scene_starts.get(self.current_frame - 1):
+            self.log.debug(f"scene cut at frame #{self.current_frame}")
+            self.scene_weights = scene.weights
+            if scene.reload:
+                for packet in set_palette(list(scene.palette)):
+                    frame_buffer[self.PACKETS_PER_FRAME - budget] = instructions.as_record(packet)
+                    budget -= 1
+            # whatever is left of the last scene would be in the wrong colors after a reload
+            preset = preset or scene.reload or self.preset_saves(next_blocks)
+
+        if preset:
+            # reset everything to the most common color to start
+            color = int(np.bincount(next_blocks.ravel()).argmax())
+            frame_buffer[self.PACKETS_PER_FRAME - budget] = instructions.as_record(instructions.preset_memory(color))
+            self.screen[:] = color
+            budget -= 1
+
+        if self.scroll:
+            with stats.stage("scroll"):
+                # judged the same way as block updates, so a scroll saves the updates it claims to
+                weights = self.scene_weights if self.priority == "perceptual" else None
+                dy, dx, saving = best_shift(
+                    self.screen, next_blocks, self.threshold, MAX_SCROLL, weights, self.spatial
+                )
+            # only worth the packets if it saves more than a frame of block writes
+            if saving > self.PACKETS_PER_FRAME:
+                self.log.debug(f"scrolling by {dy=} {dx=} blocks, saves {saving} updates")
+                # scroll instructions move one block at a time
+                for step in range(max(abs(dy), abs(dx))):
+                    step_y = int(np.sign(dy)) if step < abs(dy) else 0
+                    step_x = int(np.sign(dx)) if step < abs(dx) else 0
+                    frame_buffer[self.PACKETS_PER_FRAME - budget] = self.scroll_screen(step_y, step_x, next_blocks)
+                    budget -= 1
+
+        # get blocks to update
+        with stats.stage("updates"):
+            updates = self.calc_updates(next_blocks, self.screen, future, self.scene_weights)
+
+        # fetch the blocks we can fit this round
+        with stats.stage("schedule"):
+            rows, cols = self.scheduler.schedule(updates, budget)
+            data = updates.blocks[rows, cols]
+
+        # write out instruction packets, rest of the frame stays nop
+        with stats.stage("packets"):
+            used = self.PACKETS_PER_FRAME - budget
+            self.write_blocks(data, rows, cols, out=frame_buffer[used : used + len(data)])
+
+            # and update screen with changes
+            self.screen[rows, cols] = data
+
+        stats.end_frame(
+            changed=len(updates),
+            written=len(data),
+            backlog=self.scheduler.backlog(),
+            packets=self.PACKETS_PER_FRAME,
+            nops=budget - len(data),
+        )
 
-                self.packets += frame_packets
+        return frame_buffer.tobytes()
+
+    def preset_saves(self, next_blocks: FullFrame) -> bool:
+        """
+        whether `next_blocks` is mostly one color, so clearing the screen to it
+        leaves fewer blocks to write
+        """
+        color = np.bincount(next_blocks.ravel()).argmax()
+        after = np.count_nonzero((next_blocks != color).any(axis=(-2, -1)))
+        before = np.count_nonzero((next_blocks != self.screen).any(axis=(-2, -1)))
+
+        solid = 1 - after / (FULL_HEIGHT_BLOCKS * FULL_WIDTH_BLOCKS)
+        # preset costs a packet too
+        return solid >= DOMINANT_SHARE and after + 1 < before
+
+    def drop_frame(self) -> bytes:
+        "Skip the next frame without analysing it, leaving its changes to later frames, and return nops in its place"
+        self.current_frame += 1
+        self.log.debug(f"frame #{self.current_frame} dropped")
+
+        # a scene starting here starts on the next frame instead
+        if scene := self.scene_starts.pop(self.current_frame - 1, None):
+            self.scene_starts.setdefault(self.current_frame, scene)
+
+        self.stats.end_frame(
+            changed=0,
+            written=0,
+            backlog=self.scheduler.backlog(),
+            packets=self.PACKETS_PER_FRAME,
+            nops=self.PACKETS_PER_FRAME,
+            dropped=1,
+        )
+        return instructions.nop() * self.PACKETS_PER_FRAME
+
+    def segment_padding(self, start_frame: int, frame_count: int | None) -> bytes:
+        "nops to keep later segments in time if the source came up short"
+        if frame_count is None:
+            return b""
+
+        missing = start_frame + frame_count - self.current_frame
+        if missing <= 0:
+            return b""
+
+        self.log.warning(f"segment at frame {start_frame} is {missing} frames short, padding")
+        return instructions.nop() * self.PACKETS_PER_FRAME * missing
+
+    def iter_blocks(self, start_frame=0, frame_count=None) -> Iterator[FullFrame]:
+        "Yields frames of the source as squashed blocks, each in the palette of its scene"
+        stats = self.stats
+
+        scene = None
+        frames = stats.timed(self.iter_frames(start_frame, frame_count), "decode")
+        for index, frame in enumerate(frames, start_frame):
+            # scene is known by the time its first frame comes out
+            scene = self.scene_starts.get(index, scene)
+            with stats.stage("blocks"):
+                blocks = self.image_to_blocks(frame, scene)
+            yield blocks
+
+    def iter_frames(self, start_frame=0, frame_count=None) -> Iterator[np.ndarray]:
+        """
+        Yields palette-mapped frames of the source, from cache or the source itself.
+
+        Frames are (height, width) arrays of palette indices, in a ring of
+        reused buffers that are only valid until RING_SIZE more are read.
+
+        When detecting scenes, the scene each cut starts is added to
+        `scene_starts` before its first frame is yielded.
+        """
+
+        # scenes are found while mapping, so cant come from cached frames
+        caching = self.cache and self.cache_frames and not self.scenes
+        key = self.frames_key() if caching and self.source_digest() else None
+
+        if key and (cached := self.cache.get_frames(key)) is not None:
+            if self.monitor:
+                self.log.warning("monitor output is not written when using cached frames!")
+            end = None if frame_count is None else start_frame + frame_count
+            yield from cached[start_frame:end]
+            return
+
+        mapper = PaletteMapper(self.palette)
+        ring = [np.empty((FULL_HEIGHT, FULL_WIDTH), dtype=np.uint8) for _ in range(RING_SIZE)]
+
+        reload = self.scenes == "palettes"
+        # segments and resumed encodes dont know the palette on screen
+        tracker = SceneTracker(self.palette, reload, self.cut_threshold, resync=start_frame != 0) if self.scenes else None
+
+        # only store whole videos, not segments
+        writer = None
+        if key and start_frame == 0 and frame_count is None:
+            writer = self.cache.frame_writer(key)
+
+        try:
+            # source can only map to one palette for the whole video
+            palette = None if reload else self.palette_file.name
+            rgb_frames = self.source.frames(start_frame, frame_count, palette=palette)
+            for index, (rgb, frame) in enumerate(zip(rgb_frames, itertools.cycle(ring)), start_frame):
+                if tracker:
+                    if scene := tracker.map(index, rgb, out=frame):
+                        self.scene_starts[index] = scene
+                else:
+                    # source may already be using this palette but make sure
+                    mapper(rgb, out=frame)
+
+                if writer:
+                    writer.write(frame)
+                yield frame
+
+        except BaseException:
+            if writer:
+                writer.discard()
+            raise
+
+        if writer:
+            writer.commit()
+
+    def frames_key(self) -> str:
+        "cache key for palette-mapped frames of the source"
+        return self.cache.key(
+            self.source_digest(),
+            palette=self.palette,
+            mono=self.mono,
+            fill_frame=self.fill_frame,
+            fps=self.FRAME_RATE,
+            mapping="rgb444",
+        )
 
+    def encode(
+        self,
+        sink: BinaryIO = None,
+        chunk_size=CHUNK_SIZE,
+        workers=1,
+        resume: Checkpoint = None,
+        checkpoint_path: str | os.PathLike = None,
+        checkpoint_every=CHECKPOINT_FRAMES,
+    ):
+        """
+        Encode frames.
+
+        By default, packets are collected in memory for `save()`. If a writable
+        file-like `sink` is given, packets are instead written out to it in
+        chunks of about `chunk_size` bytes as they are encoded.
+
+        With more than one worker, the video is split into time segments that
+        are encoded in parallel processes and stitched back together in order.
+
+        If the video was set up with `pipeline`, decoding and block squashing
+        run a few frames ahead in a reader thread, and writes to `sink` happen
+        in a writer thread, overlapping with the analysis of each frame. The
+        output is the same either way.
+
+        When streaming to `sink`, a checkpoint is saved to `checkpoint_path`
+        (if given) every `checkpoint_every` frames, once everything before it
+        has been written out. Encoding carries on from checkpoint `resume`
+        if given, see `stream()`.
+
+        Audio extraction for `save_audio()` starts in the background first.
+        """
+
+        assert workers <= 1 or not (resume or checkpoint_path), "cannot checkpoint parallel encodes!"
+
+        if self.audio:
+            self.audio.start()
+
+        try:
+            return self._encode(sink, chunk_size, workers, resume, checkpoint_path, checkpoint_every)
+        except BaseException:
+            # nothing to save audio alongside
+            if self.audio:
+                self.audio.cancel()
+            raise
+
+    def _encode(
+        self,
+        sink: BinaryIO,
+        chunk_size: int,
+        workers: int,
+        resume: Checkpoint | None,
+        checkpoint_path: str | os.PathLike | None,
+        checkpoint_every: int,
+    ):
+        chunks = self.iter_packets(resume=resume) if workers <= 1 else self.iter_segments(workers)
+
+        if sink is None:
+            for chunk in chunks:
+                with self.stats.stage("output"):
+                    self.packets += [chunk[i : i + PACKET_SIZE] for i in range(0, len(chunk), PACKET_SIZE)]
+            self.log_stats()
+            return self
+
+        # writes happen in the background when pipelined
+        writer = ThreadedWriter(sink, PIPELINE_DEPTH) if self.pipeline else contextlib.nullcontext(sink)
+
+        with writer as out:
+            buffer = bytearray()
+            for chunk in chunks:
+                with self.stats.stage("output"):
+                    buffer += chunk
+                    self.packets_written += len(chunk) // PACKET_SIZE
+
+                    checkpoint = checkpoint_path and self.current_frame % checkpoint_every == 0
+                    if len(buffer) >= chunk_size or checkpoint:
+                        out.write(buffer)
+                        # writer may not be done with it yet
+                        buffer = bytearray()
+
+                if checkpoint:
+                    save = functools.partial(self.save_checkpoint, self.checkpoint(), checkpoint_path, sink)
+                    if self.pipeline:
+                        # only once the output it covers is written
+                        out.call(save)
+                    else:
+                        save()
+
+            with self.stats.timing("flush"):
+                out.write(buffer)
+
+        self.log_stats()
+        return self
+
+    def log_stats(self):
+        "Log summary of the last encode"
+        summary = self.stats.summary()
+        self.log.info(
+            f"encoded {summary['frames']} frames in {summary['elapsed']:.1f}s "
+            f"({summary['fps']:.1f} fps, {summary['packets_per_second']:.0f} packets/s), "
+            f"{summary['mean_written']:.1f} blocks written per frame, "
+            f"{summary['nop_ratio']:.0%} nops"
+        )
+
+    def iter_segments(self, workers: int, segment_frames: int = None) -> Iterator[bytes]:
+        "Encode time segments across a pool of `workers` processes, yielding each in order"
+
+        if self.monitor:
+            self.log.warning("monitor output is not written when encoding in parallel!")
+
+        total = self.frame_count()
+        assert total is not None, "can only encode in parallel from sources of known length!"
+        if segment_frames is None:
+            segment_frames = math.ceil(total / workers)
+        starts = range(0, total, segment_frames)
+
+        self.log.info(f"encoding {total} frames in {len(starts)} segments across {workers} workers")
+
+        self.stats = EncodeStats(self.PACKETS_PER_FRAME)
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            # last segment runs until the end of the source
+            counts = [segment_frames] * (len(starts) - 1) + [None]
+            for packets, stats in pool.map(self.encode_segment, starts, counts):
+                self.stats.merge(stats)
+                yield packets
+
+        self.current_frame = total
+
+    def encode_segment(self, start_frame: int, frame_count: int = None) -> tuple[bytes, EncodeStats]:
+        "Encode a single time segment to packets and its stats (runs in worker processes)"
+        packets = b"".join(self.iter_packets(start_frame, frame_count))
+        return packets, self.stats
+
+    def __getstate__(self):
+        "drop state that can't (or shouldn't) be sent to worker processes"
+        state = self.__dict__.copy()
+        # workers only need the palette file name, the parent keeps it alive
+        state["palette_file"] = SimpleNamespace(name=self.palette_file.name)
+        state["packets"] = []
+        state["audio"] = None
+        return state
+
+    def save_checkpoint(self, checkpoint: Checkpoint, path: str | os.PathLike, sink: BinaryIO):
+        "flush output to `sink`, then save `checkpoint` of it to `path`"
+        with self.stats.timing("checkpoint"):
+            sink.flush()
+            checkpoint.save(path)
+        self.log.debug(f"saved checkpoint at frame {checkpoint.frame}")
+
+    def stream(self, name: str, overwrite=False, workers=1, checkpoint_every: int = None, resume=False):
+        """
+        Encode directly to `name`.cdg without holding packets in memory, then write out audio.
+
+        With `checkpoint_every`, encoder state is saved to `name`.cdg.ckpt every
+        that many frames, and removed once done. With `resume`, an encode that
+        was stopped carries on from its last checkpoint, if there is one.
+        """
+        self.log.info(f"streaming to {name}.cdg")
+
+        path, checkpoint_path = f"{name}.cdg", f"{name}.cdg.ckpt"
+        checkpoint = None
+        if resume and os.path.exists(checkpoint_path):
+            checkpoint = Checkpoint.load(checkpoint_path)
+            assert os.path.getsize(path) >= checkpoint.offset, f"{path} is shorter than its checkpoint!"
+            # anything after the checkpoint gets encoded again
+            self.packets_written = checkpoint.offset // PACKET_SIZE
+        elif resume:
+            self.log.warning(f"no checkpoint at {checkpoint_path}, starting from the beginning")
+
+        mode = "r+b" if checkpoint else "wb" if overwrite else "xb"
+        with open(path, mode=mode) as cdgfile:
+            if checkpoint:
+                cdgfile.truncate(checkpoint.offset)
+                cdgfile.seek(checkpoint.offset)
+
+            self.encode(
+                sink=cdgfile,
+                workers=workers,
+                resume=checkpoint,
+                checkpoint_path=checkpoint_path if checkpoint_every else None,
+                checkpoint_every=checkpoint_every,
+            )
+
+        if os.path.exists(checkpoint_path):
+            os.unlink(checkpoint_path)
+
+        with self.stats.timing("save_audio"):
+            self.save_audio(name, overwrite)
+        return self
+
+    def reencode(self, path: str | os.PathLike, start_frame: int, frame_count: int, settle=SETTLE_FRAMES):
+        """
+        Re-encode `frame_count` frames from `start_frame` of existing .cdg at
+        `path`, and splice them into it in place.
+
+        The screen at `start_frame` is recovered by decoding the file up to
+        there, so the video must be set up with the palette it was encoded
+        with. Encoding then runs on past the range for up to `settle` frames,
+        aiming for what the original shows instead of the source, until the
+        screen matches it again. That way the rest of the file carries on
+        from the state it expects.
+        """
+        assert self.scenes != "palettes", "cannot splice into videos with a palette per scene!"
+
+        packets = read_packets(path)
+        total = (len(packets) - HEADER_PACKETS) // self.PACKETS_PER_FRAME
+        assert 0 <= start_frame and start_frame + frame_count <= total, f"{path} only has {total} frames!"
+
+        offset = lambda frame: HEADER_PACKETS + frame * self.PACKETS_PER_FRAME
+
+        # what the original shows at the start of the range
+        original = Decoder()
+        original.feed(packets[: offset(start_frame)])
+        colors = [rgb_to_444(c) for c in self.palette] + [(0, 0, 0)] * (PALETTE_SIZE - len(self.palette))
+        assert np.array_equal(original.colors, np.array(colors) * 17), f"{path} uses a different palette!"
+
+        self.resume_encode(
+            Checkpoint(
+                frame=start_frame,
+                offset=offset(start_frame) * PACKET_SIZE,
+                screen=to_blocks(original.screen),
+                # nothing is known about waiting blocks
+                age=np.zeros((FULL_HEIGHT_BLOCKS, FULL_WIDTH_BLOCKS), dtype=np.int64),
+                palette=self.palette,
+                settings=self.settings(),
+            )
+        )
+
+        chunks = []
+        frames = self.iter_blocks(start_frame, frame_count)
+        for next_blocks, future in lookahead(frames, self.lookahead):
+            chunks.append(self.encode_frame(next_blocks, future))
+            # keep original in step
+            original.feed(packets[offset(self.current_frame - 1) : offset(self.current_frame)])
+
+        if self.current_frame < start_frame + frame_count:
+            self.log.warning(f"source ran out at frame {self.current_frame}")
+
+        # catch up with the original, so its later updates land on the screen they expect
+        settle_end = min(start_frame + frame_count + settle, total)
+        while self.current_frame < settle_end and not np.array_equal(to_blocks(original.screen), self.screen):
+            original.feed(packets[offset(self.current_frame) : offset(self.current_frame + 1)])
+            chunks.append(self.encode_frame(to_blocks(original.screen).copy()))
+
+        if not np.array_equal(to_blocks(original.screen), self.screen):
+            self.log.warning(
+                f"screen still differs from the original after frame {self.current_frame}, "
+                "some blocks may be stale until they are next written"
+            )
+
+        with open(path, "r+b") as cdgfile:
+            cdgfile.seek(offset(start_frame) * PACKET_SIZE)
+            cdgfile.write(b"".join(chunks))
+
+        self.log.info(f"re-encoded frames {start_frame} to {self.current_frame} of {path}")
+        return self
+
+    def live(self, sink: BinaryIO, latency=LIVE_LATENCY):
+        """
+        Encode and send packets to `sink` in real time, for live playback.
+
+        Packets go out at PACKETS_PER_SECOND, at most `latency` seconds ahead
+        of the wall clock. If encoding (or a slow receiver) falls more than a
+        frame behind, source frames are dropped without being analysed, and
+        a frame of nops sent in their place, until it catches up, so latency
+        stays bounded and the stream keeps time. Dropped changes are still on
+        the scheduler backlog, and written by later frames.
+
+        Lookahead is not used, and no audio is written.
+        """
+        self.log.info(f"streaming live, {latency}s ahead")
+        if self.lookahead:
+            self.log.warning("lookahead is not used when streaming live!")
+
+        out = PacedWriter(sink, latency)
+        frame_time = self.PACKETS_PER_FRAME / PACKETS_PER_SECOND
+
+        if header := self.start_encode():
+            out.write(header)
+
+        stats = self.stats
+        frames = stats.timed(self.iter_frames(), "decode")
+        if self.pipeline:
+            # keep decoding while waiting to send
+            frames = stats.consume(threaded(stats.produce(frames), PIPELINE_DEPTH))
+
+        scene = None
+        for index, frame in enumerate(frames):
+            scene = self.scene_starts.get(index, scene)
+
+            if out.lag() > frame_time:
+                # nops go out straight away, so receivers stay in step while this catches up
+                packets = self.drop_frame()
+            else:
+                with stats.stage("blocks"):
+                    next_blocks = self.image_to_blocks(frame, scene)
+                packets = self.encode_frame(next_blocks)
+
+            with stats.stage("output"):
+                out.write(packets)
+                self.packets_written += self.PACKETS_PER_FRAME
+
+        summary = stats.summary()
+        self.log_stats()
+        if summary["dropped_frames"]:
+            self.log.warning(f"dropped {summary['dropped_frames']} frames to keep up")
         return self
 
     def save(self, name: str, overwrite=False):
-        "Save encoded CDG stream to `name`.cdg and `name`.mp3"
+        "Save encoded CDG stream to `name`.cdg, and audio alongside it"
         assert (
             len(self.packets) != 0
         ), "cannot save before encoding! run `encode()` first"
-        self.log.info(f"saving to {name}.cdg/.mp3")
+        self.log.info(f"saving to {name}.cdg")
 
         mode = "wb" if overwrite else "xb"
-        with open(f"{name}.cdg", mode=mode) as cdgfile:
+        with self.stats.timing("save"), open(f"{name}.cdg", mode=mode) as cdgfile:
             cdgfile.writelines(self.packets)
 
         # also write out audio
-        mp3 = (
-            ffmpeg.input(self.source).output(f"{name}.mp3").global_args("-hide_banner")
-        )
-        if overwrite:
-            mp3 = mp3.overwrite_output()
-        mp3.run(quiet=self.quiet)
+        with self.stats.timing("save_audio"):
+            self.save_audio(name, overwrite)
+
+    def save_audio(self, name: str, overwrite=False):
+        "Write source audio out to `name`.mp3 (or other audio format), once extraction finishes"
+        if self.audio is None:
+            self.log.info("source has no audio, not writing any")
+            return
+
+        self.log.info(f"saving audio to {name}.{self.audio.format}")
+        self.audio.finish(f"{name}.{self.audio.format}", overwrite)
+
+    @classmethod
+    async def acreate(cls, *args, executor=None, **kwargs) -> "Video":
+        "Async constructor, sets up the video (and derives its palette) in `executor`"
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(cls, *args, **kwargs))
+
+    async def aiter_packets(self, executor=None, progress: ProgressCallback = None) -> AsyncIterator[bytes]:
+        """
+        Async version of `iter_packets()`, for a whole video.
+
+        Frames are read from the source without blocking the event loop, and
+        the CPU heavy stages run in `executor` (the loop default if not given).
+        After each frame, `progress(frames_done, total_frames)` is called, with
+        total None if unknown. The frame cache is not used.
+        """
+        assert not self.scenes, "scene detection is not supported by async encodes!"
+        loop = asyncio.get_running_loop()
+
+        def run(fn, *args):
+            return loop.run_in_executor(executor, fn, *args)
+
+        total = await run(self.frame_count)
+
+        if header := await run(self.start_encode, 0):
+            yield header
+
+        mapper = PaletteMapper(self.palette)
+
+        def blocks(rgb):
+            with self.stats.stage("blocks"):
+                return self.image_to_blocks(mapper(rgb))
+
+        rgb_frames = self.source.aframes(palette=self.palette_file.name, executor=executor)
+        frames = (await run(blocks, rgb) async for rgb in rgb_frames)
+
+        try:
+            async for next_blocks, future in alookahead(frames, self.lookahead):
+                yield await run(self.encode_frame, next_blocks, future)
+                if progress:
+                    progress(self.current_frame, total)
+        finally:
+            # stop decoding straight away when stopped early or cancelled
+            await rgb_frames.aclose()
+
+    async def aencode(self, sink=None, executor=None, progress: ProgressCallback = None):
+        """
+        Async version of `encode()`, so one event loop can run many encodes.
+
+        `sink` can be a file-like object, or an asyncio StreamWriter which is
+        drained after each write. Cancelling stops decoding and audio extraction.
+        See `aiter_packets()` for `executor` and `progress`.
+        """
+        if self.audio:
+            self.audio.start()
+
+        try:
+            async for chunk in self.aiter_packets(executor, progress):
+                if sink is None:
+                    self.packets += [chunk[i : i + PACKET_SIZE] for i in range(0, len(chunk), PACKET_SIZE)]
+                    continue
+
+                sink.write(chunk)
+                self.packets_written += len(chunk) // PACKET_SIZE
+                if hasattr(sink, "drain"):
+                    await sink.drain()
+        except BaseException:
+            if self.audio:
+                self.audio.cancel()
+            raise
+
+        self.log_stats()
+        return self
 
-    def image_to_blocks(self, image: Image.Image) -> DisplayFrame | FullFrame:
-        "groups `image` pixel data into (numpy) array of block tiles"
-        # adapted from: https://stackoverflow.com/a/16858283
+    async def asave(self, name: str, overwrite=False, executor=None):
+        "Async version of `save()`, writing files and waiting for audio in `executor`"
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(executor, functools.partial(self.save, name, overwrite))
 
-        assert image.mode == "P"
-        arr = np.array(image)
+    def image_to_blocks(self, image: np.ndarray, scene: Scene = None) -> DisplayFrame | FullFrame:
+        """
+        groups palette-mapped `image` pixel data into (numpy) array of two-color block tiles,
+        in the palette of `scene` if given
+        """
 
-        h, w = arr.shape
-        assert (
-            h % BLOCK_HEIGHT == 0
-        ), f"{h} rows is not evenly divisible by {BLOCK_HEIGHT}"
-        assert (
-            w % BLOCK_WIDTH == 0
-        ), f"{w} cols is not evenly divisible by {BLOCK_WIDTH}"
-
-        # chunked, but one dimensional
-        blocks_1d = (
-            arr.reshape(h // BLOCK_HEIGHT, BLOCK_HEIGHT, -1, BLOCK_WIDTH)
-            .swapaxes(1, 2)
-            .reshape(-1, BLOCK_HEIGHT, BLOCK_WIDTH)
-        )
+        assert image.dtype == np.uint8 and image.ndim == 2
+        blocks = to_blocks(image)
 
         # need to convert each block to two colors only
-        # nested func for map
-        def squash_colors(block: Block) -> Block:
-            bimg = Image.fromarray(block, mode="P")
-            bimg.putpalette(itertools.chain(*self.palette))
-
-            # tiles need max two colors from the overall 16
-            # this two-step-monty isnt great and probably loses some color, but it does work
-            # colors= and palette= are exclusive
-            # TODO: can this be made any better?
-            squashed = (
-                bimg
-                # squish to two arbitrary colors
-                .convert("RGB")
-                .quantize(colors=2)
-                # fit back in original palette (no dither to preserve the two colors)
-                .convert("RGB")
-                .quantize(palette=image, dither=Image.Dither.NONE)
-            )
-            # (palette index is the same as original)
+        if self.squash == "numpy":
+            if scene:
+                return squash_blocks(blocks, scene.distances, scene.costs)
+            return squash_blocks(blocks, self.distances, self.pair_costs)
+
+        # palette-only image for quantizing back to the palette
+        palimg = Image.new("P", (1, 1))
+        palimg.putpalette(itertools.chain(*(scene.palette if scene else self.palette)))
+
+        rows, cols = blocks.shape[:2]
+        squashed = [self.squash_colors(block, palimg) for block in blocks.reshape(-1, BLOCK_HEIGHT, BLOCK_WIDTH)]
+        return np.array(squashed).reshape(rows, cols, BLOCK_HEIGHT, BLOCK_WIDTH)
+
+    def squash_colors(self, block: Block, image: Image.Image) -> Block:
+        "convert single block to two colors using PIL quantize (slow path)"
+        bimg = Image.fromarray(block, mode="P")
+        # same palette as `image`
+        bimg.putpalette(image.getpalette())
+
+        # tiles need max two colors from the overall 16
+        # this two-step-monty isnt great and probably loses some color, but it does work
+        # colors= and palette= are exclusive
+        squashed = (
+            bimg
+            # squish to two arbitrary colors
+            .convert("RGB")
+            .quantize(colors=2)
+            # fit back in original palette (no dither to preserve the two colors)
+            .convert("RGB")
+            .quantize(palette=image, dither=Image.Dither.NONE)
+        )
+        # (palette index is the same as original)
 
-            # convert back to byte array
-            return np.array(squashed)
+        # convert back to byte array
+        return np.array(squashed)
 
-        blocks_1d = np.array([squash_colors(block) for block in blocks_1d])
+    def scroll_screen(self, dy: int, dx: int, next_blocks: FullFrame) -> np.ndarray:
+        "scroll screen by `dy`, `dx` blocks, and return the scroll instruction packet"
 
-        # split chunk list back into 2d (split into X cols)
-        return np.split(blocks_1d, h / BLOCK_HEIGHT)
+        # fill exposed edges with whatever is most common there next
+        edge = lambda d: slice(None, d) if d > 0 else slice(d, None)
+        exposed = []
+        if dy:
+            exposed.append(next_blocks[edge(dy)].ravel())
+        if dx:
+            exposed.append(next_blocks[:, edge(dx)].ravel())
+        fill = int(np.bincount(np.concatenate(exposed)).argmax())
 
-    def calc_updates(self, next: Image.Image, prev: Image.Image) -> queue.PriorityQueue:
-        "calculate list of blocks to change in order of largest difference"
+        self.screen = shift_blocks(self.screen, dy, dx, fill)
+        self.scheduler.shift(dy, dx)
 
-        # cells need at least this many pixels changed to be tracked
-        PIXEL_THRESHOLD = 4
+        packet = instructions.scroll_preset(
+            fill, instructions.scroll_command(dx), instructions.scroll_command(dy)
+        )
+        return instructions.as_record(packet)
 
-        # array shape: 16x48 x 12x6
+    def calc_updates(
+        self,
+        next_blocks: FullFrame,
+        screen: FullFrame,
+        future: list[FullFrame] = None,
+        weights: np.ndarray = None,
+    ) -> Updates:
+        """
+        Calculate blocks of `next_blocks` to change on `screen`, ranked by largest difference.
+
+        If blocks of `future` frames are given, blocks that are about to change
+        again are deferred in favour of ones that will stay put.
+        With perceptual priority, changes are weighed by `weights` of the palette
+        on screen, or the global palette's if not given.
+        """
+
+        # array shape: 18x50 x 12x6
         # (blocks in canvas)   (pixels in block)
-        prev_blocks = self.image_to_blocks(prev)
-        next_blocks = self.image_to_blocks(next)
 
-        updates = queue.PriorityQueue()
-        # delta entry format:
-        # (priority, row, col, new_block_data)
+        if self.priority == "perceptual":
+            # sum how different each changed pixel looks, in the palette of `weights`
+            weights = self.weights if weights is None else weights
+            deltas = weighted_deltas(screen, next_blocks, weights, self.spatial)
+        else:
+            # count number of differing pixels in each block
+            deltas = block_deltas(screen, next_blocks)
 
-        # count number of differing pixels
-        diff = lambda a, b: len([True for ai, bi in zip(a.flat, b.flat) if ai != bi])
+        if future:
+            # scale down by how soon each block changes again
+            stable = block_stability(next_blocks, future, self.PIXEL_THRESHOLD)
+            deltas = deltas * (1 + stable) / (1 + len(future))
 
-        for row_i, rows in enumerate(np.stack((prev_blocks, next_blocks), 2)):
-            for col_i, (pblock, nblock) in enumerate(rows):
-                block_diff = diff(pblock, nblock)
-                if block_diff > PIXEL_THRESHOLD:
-                    # negative delta, since PQ fetches lowest values first
-                    updates.put((-block_diff, row_i, col_i, nblock))
+        updates = Updates(deltas, next_blocks, threshold=self.threshold)
 
-        self.log.debug(f"generated {updates.qsize()} updates")
+        self.log.debug(f"generated {len(updates)} updates")
         return updates
 
     def write_block(self, block: Block, row: int, col: int) -> bytes:
         "converts block to fg/bg and returns generated instruction"
+        return bytes(self.write_blocks(block[None], [row], [col]))
 
-        # self.log.trace(f"writing block at {row=} {col=}")
-        colors = np.unique(block).tolist()
+    def write_blocks(self, blocks: np.ndarray, rows, cols, out: np.ndarray = None) -> memoryview:
+        "converts (N, 12, 6) `blocks` to fg/bg and returns generated instructions in one buffer"
 
-        assert len(colors) in [1, 2], "too many colors in block!"
+        # self.log.trace(f"writing {len(blocks)} blocks")
 
-        if len(colors) == 1:
-            fg = bg = colors[0]
-        else:
-            fg, bg = colors
+        # blocks are already squashed to two colors, lower index is fg
+        flat = blocks.reshape(len(blocks), BLOCK_HEIGHT * BLOCK_WIDTH)
+        fg, bg = flat.min(axis=1), flat.max(axis=1)
+        assert (
+            (flat == fg[:, None]) | (flat == bg[:, None])
+        ).all(), "too many colors in block!"
 
         # turn palette index into fg/bg bools
-        bools = np.vectorize(lambda x: x == fg)(block)
-        # only lower 6 bits are used, so pad to 8 bits for packing
-        padded = np.pad(bools, ((0, 0), (2, 0)))
-        # pack bools into bitfield
-        bits = b"".join(np.packbits(padded))
+        bitmaps = blocks == fg[:, None, None]
 
-        return instructions.write_font_block(bg, fg, row, col, bits)
+        return instructions.font_blocks(rows, cols, bg, fg, bitmaps, out=out)
@@ -0,0 +1,72 @@
+import socket
+import sys
+import time
+from typing import BinaryIO
+
+from .constants import *
+
+"""
+Real-time output of CD+G packets, paced against the wall clock.
+"""
+
+# seconds of stream to send ahead of real time by default
+LIVE_LATENCY = 0.1
+
+
+class PacedWriter:
+    """
+    Writes packets to file-like `sink` at `rate` packets per second.
+
+    At most `latency` seconds of packets are sent ahead of the wall clock, so
+    a receiver playing them as they come is never more than that far behind.
+    """
+
+    def __init__(self, sink: BinaryIO, latency=LIVE_LATENCY, rate=PACKETS_PER_SECOND) -> None:
+        self.sink = sink
+        self.latency = latency
+        self.rate = rate
+
+        # packets sent so far, which the stream clock is counted in
+        self.packets = 0
+        self.start: float | None = None
+
+    def due(self) -> float:
+        "wall time the next packet is due to play at"
+        if self.start is None:
+            self.start = time.perf_counter()
+        return self.start + self.packets / self.rate
+
+    def lag(self) -> float:
+        "seconds the stream is behind the wall clock, negative when ahead"
+        return time.perf_counter() - self.due()
+
+    def write(self, data: bytes):
+        "send `data` once it is within `latency` of being due"
+        if (wait := -self.lag() - self.latency) > 0:
+            time.sleep(wait)
+
+        self.sink.write(data)
+        # pipes and sockets should not sit on packets
+        if hasattr(self.sink, "flush"):
+            self.sink.flush()
+        self.packets += len(data) // PACKET_SIZE
+
+
+def open_live_sink(target: str) -> BinaryIO:
+    """
+    Open live output `target`: `-` for stdout, `tcp://host:port` to listen
+    and wait for one client to connect, or else a path such as a FIFO.
+    """
+    if target == "-":
+        return sys.stdout.buffer
+
+    if target.startswith("tcp://"):
+        host, _, port = target.removeprefix("tcp://").rpartition(":")
+        with socket.create_server((host or "localhost", int(port))) as server:
+            conn, _ = server.accept()
+        # small writes go out straight away
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return conn.makefile("wb")
+
+    # opening a FIFO blocks until something opens it for reading
+    return open(target, "wb")
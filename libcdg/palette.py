@@ -0,0 +1,139 @@
+import numpy as np
+from PIL import Image
+
+from .constants import *
+
+"""
+Palette estimation from sampled frames, in the RGB444 space CD+G can display.
+"""
+
+
+# levels per channel in RGB444
+LEVELS = 16
+
+
+def to_444(pixels: np.ndarray) -> np.ndarray:
+    "convert array of RGB24 (0-255) values to RGB444 levels (0-15)"
+    return ((pixels.astype(np.uint16) * (LEVELS - 1) + 127) // 255).astype(np.uint8)
+
+
+def from_444(levels: np.ndarray) -> np.ndarray:
+    "convert array of RGB444 levels (0-15) to the RGB24 (0-255) values they display as"
+    return levels.astype(np.uint8) * (255 // (LEVELS - 1))
+
+
+def kmeans_444(pixels: np.ndarray, colors=PALETTE_SIZE, iterations=20) -> list[tuple[int, int, int]]:
+    """
+    Cluster RGB24 `pixels` into at most `colors` colors.
+
+    Clustering runs over a histogram of the pixels in RGB444, so the cost does
+    not depend on how many pixels were sampled, and the resulting centers are
+    snapped back to the RGB444 grid so they can be displayed exactly.
+    """
+    levels = to_444(np.asarray(pixels).reshape(-1, 3)).astype(np.intp)
+
+    # histogram over all 4096 RGB444 colors
+    codes = (levels[:, 0] * LEVELS + levels[:, 1]) * LEVELS + levels[:, 2]
+    counts = np.bincount(codes, minlength=LEVELS**3)
+
+    used = np.flatnonzero(counts)
+    weights = counts[used].astype(np.float64)
+    points = np.stack(np.unravel_index(used, (LEVELS,) * 3), axis=1).astype(np.float64)
+
+    # few enough colors to use as-is
+    if len(used) <= colors:
+        return [tuple(c) for c in from_444(points).tolist()]
+
+    # deterministic farthest-point init, starting from the most common color
+    centers = [points[weights.argmax()]]
+    nearest = ((points - centers[0]) ** 2).sum(axis=1)
+    for _ in range(colors - 1):
+        centers.append(points[(nearest * weights).argmax()])
+        nearest = np.minimum(nearest, ((points - centers[-1]) ** 2).sum(axis=1))
+    centers = np.array(centers)
+
+    for _ in range(iterations):
+        dists = ((points[:, None, :] - centers[None, :, :]) ** 2).sum(axis=-1)
+        labels = dists.argmin(axis=1)
+
+        # weighted mean of each cluster (empty clusters keep their center)
+        totals = np.zeros_like(centers)
+        np.add.at(totals, labels, points * weights[:, None])
+        sizes = np.bincount(labels, weights=weights, minlength=colors)
+        moved = np.where(sizes[:, None] > 0, totals / np.maximum(sizes, 1)[:, None], centers)
+
+        if np.allclose(moved, centers):
+            break
+        centers = moved
+
+    # snap to displayable colors, and remove duplicates
+    snapped = np.unique(np.rint(centers).astype(np.uint8), axis=0)
+    return [tuple(c) for c in from_444(snapped).tolist()]
+
+
+def write_palette_image(palette: list[tuple[int, int, int]], path: str):
+    "save `palette` as a 16x16 image, as expected by ffmpeg paletteuse"
+    assert 0 < len(palette) <= PALETTE_SIZE, f"bad palette size {len(palette)}!"
+
+    # repeat colors to fill all 256 entries
+    pixels = np.array([palette[i % len(palette)] for i in range(256)], dtype=np.uint8)
+    Image.fromarray(pixels.reshape(16, 16, 3)).save(path)
+
+
+def color_codes(pixels: np.ndarray) -> np.ndarray:
+    "12-bit RGB444 codes of RGB24 `pixels`, the top 4 bits of each channel as 0xBGR"
+    pixels = np.asarray(pixels, dtype=np.uint16)
+    return (pixels[..., 0] >> 4) | (pixels[..., 1] & 0xF0) | ((pixels[..., 2] & 0xF0) << 4)
+
+
+def palette_lut(palette: list[tuple[int, int, int]]) -> np.ndarray:
+    "table from every 12-bit RGB444 color code to the index of the nearest `palette` color"
+    codes = np.arange(LEVELS**3)
+    # middle of the range of colors each code covers
+    centers = np.stack([codes & 0xF, (codes >> 4) & 0xF, codes >> 8], axis=1) * 16 + 8
+
+    colors = np.array(palette, dtype=np.intp)
+    dists = ((centers[:, None, :] - colors[None, :, :]) ** 2).sum(axis=-1)
+    lut = dists.argmin(axis=1).astype(np.uint8)
+
+    # palette colors always map to themselves, first one wins if they share a code
+    lut[color_codes(colors)[::-1]] = np.arange(len(colors))[::-1]
+    return lut
+
+
+class PaletteMapper:
+    """
+    Maps RGB24 frames to palette indices through an RGB444 lookup table.
+
+    Each frame takes a few whole-array bit operations into preallocated
+    scratch space and a single gather, rather than a nearest color search.
+    """
+
+    def __init__(self, palette: list[tuple[int, int, int]], shape=(FULL_HEIGHT, FULL_WIDTH)) -> None:
+        self.lut = palette_lut(palette)
+
+        self._codes = np.empty(shape, dtype=np.uint16)
+        self._scratch = np.empty(shape, dtype=np.uint16)
+
+    def __call__(self, frame: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        "palette indices of (height, width, 3) `frame`, written into `out` if given"
+        codes, scratch = self._codes, self._scratch
+
+        # pixels need packed channels, rows can be anywhere (such as a crop of a bigger frame)
+        if frame.strides[1:] != (3, 1):
+            frame = np.ascontiguousarray(frame)
+
+        # red and green of each pixel in one (little endian, unaligned) 16 bit read
+        rg = frame[..., :2].view("<u2")[..., 0]
+
+        # same as color_codes, without temporaries
+        np.right_shift(rg, 4, out=codes)
+        np.bitwise_and(codes, 0x00F, out=codes)
+        np.right_shift(rg, 8, out=scratch)
+        np.bitwise_and(scratch, 0x0F0, out=scratch)
+        np.bitwise_or(codes, scratch, out=codes)
+        np.left_shift(frame[..., 2], 4, out=scratch, dtype=np.uint16)
+        np.bitwise_and(scratch, 0xF00, out=scratch)
+        np.bitwise_or(codes, scratch, out=codes)
+
+        return np.take(self.lut, codes, out=out)
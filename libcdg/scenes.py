@@ -0,0 +1,91 @@
+import numpy as np
+
+from .blocks import color_weights, pair_costs, palette_distances
+from .constants import *
+from .palette import PaletteMapper, color_codes, kmeans_444
+
+"""
+Hard cut detection, and palettes for each scene.
+"""
+
+# share of (sampled) pixels that have to change coarse color for a frame to count as a cut
+CUT_THRESHOLD = 0.5
+
+# cuts closer together than this many frames are ignored, like flashes or strobing
+MIN_SCENE_FRAMES = 15
+
+# share of blocks that have to be one solid color to clear the screen to it at a cut
+DOMINANT_SHARE = 0.5
+
+# pixels to skip in each direction when comparing frames
+SAMPLE_STEP = 4
+
+# top two bits of each channel of RGB444 codes, so noise and gradients dont count as change
+COARSE_MASK = 0xCCC
+
+
+class Scene:
+    "Palette in use from frame `start` onwards, `reload`ed at the start of the scene if it changed"
+
+    def __init__(self, start: int, palette: list[tuple[int, int, int]], reload=False) -> None:
+        self.start = start
+        self.palette = palette
+        self.reload = reload
+
+        # color distance lookups for block squashing
+        self.distances = palette_distances(palette)
+        self.costs = pair_costs(self.distances)
+        # and for perceptual block priority
+        self.weights = color_weights(palette)
+
+
+class SceneTracker:
+    """
+    Maps frames to palette indices in order, spotting hard cuts between them.
+
+    Frames start off in `palette`. With `reload`, each scene after that gets
+    its own palette derived from its first frame, and if the palette on screen
+    is not known (`resync`), the first frame starts a scene to set it again.
+    Otherwise `palette` is used throughout, and cuts are only marked.
+    """
+
+    def __init__(
+        self, palette: list[tuple[int, int, int]], reload=False, threshold=CUT_THRESHOLD, resync=False
+    ) -> None:
+        self.palette = palette
+        self.reload = reload
+        self.threshold = threshold
+        self.resync = resync
+
+        self.mapper = PaletteMapper(palette)
+        # sampled pixels of the previous frame, and where its scene started
+        self.prev: np.ndarray | None = None
+        self.start: int | None = None
+
+    def map(self, index: int, rgb: np.ndarray, out: np.ndarray) -> Scene | None:
+        "map `rgb` frame number `index` into `out`, returns the scene it starts if any"
+        self.mapper(rgb, out=out)
+        # compare colors before mapping, so they dont depend on the palette of the scene
+        sample = color_codes(rgb[::SAMPLE_STEP, ::SAMPLE_STEP]) & COARSE_MASK
+
+        if self.prev is None:
+            cut = self.reload and self.resync
+        else:
+            changed = np.count_nonzero(sample != self.prev) / sample.size
+            cut = changed > self.threshold and index - self.start >= MIN_SCENE_FRAMES
+
+        scene = None
+        if cut:
+            # first frame sets the palette again as it is
+            palette = kmeans_444(rgb) if self.reload and self.prev is not None else self.palette
+            reload = self.reload and (self.prev is None or palette != self.palette)
+            if reload:
+                self.palette = palette
+                self.mapper = PaletteMapper(palette)
+                self.mapper(rgb, out=out)
+            scene = Scene(index, self.palette, reload)
+
+        if cut or self.prev is None:
+            self.start = index
+        self.prev = sample
+        return scene
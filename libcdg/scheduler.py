@@ -0,0 +1,58 @@
+import numpy as np
+
+from .blocks import Updates, rank_blocks, shift_blocks
+
+"""
+Decides which blocks get written each frame.
+"""
+
+
+class Scheduler:
+    """
+    Schedules block updates across frames.
+
+    Blocks that differ from the screen but don't get written stay in the
+    backlog, and their priority grows with every frame they wait so they
+    can't be starved forever. Spare packets in quiet frames go to draining
+    smaller changes that didn't make the threshold.
+    """
+
+    def __init__(self, shape: tuple[int, int], aging=0.25) -> None:
+        # frames each block has been waiting to be written
+        self.age = np.zeros(shape, dtype=np.int64)
+        # extra priority per frame waited, as fraction of original
+        self.aging = aging
+
+    def schedule(self, updates: Updates, budget: int) -> tuple[np.ndarray, np.ndarray]:
+        "pick up to `budget` blocks to write this frame, as arrays of rows and cols"
+
+        pending = updates.priority > 0
+        # blocks that have caught up (or changed back) are not waiting anymore
+        self.age[~pending] = 0
+
+        priority = updates.priority * (1 + self.aging * self.age)
+
+        # changes big enough to track first
+        chosen = rank_blocks(priority, budget, updates.threshold)
+
+        # then drain smaller changes with whatever is left
+        if len(chosen) < budget:
+            rest = priority.copy()
+            rest.flat[chosen] = 0
+            chosen = np.concatenate((chosen, rank_blocks(rest, budget - len(chosen))))
+
+        rows, cols = np.divmod(chosen, priority.shape[1])
+
+        # everything still pending waits another frame
+        self.age[pending] += 1
+        self.age[rows, cols] = 0
+
+        return rows, cols
+
+    def shift(self, dy: int, dx: int):
+        "move waiting blocks along with a scroll of the screen"
+        self.age = shift_blocks(self.age, dy, dx, fill=0)
+
+    def backlog(self) -> int:
+        "number of blocks still waiting to be written"
+        return int(np.count_nonzero(self.age))
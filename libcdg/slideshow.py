@@ -0,0 +1,171 @@
+import concurrent.futures
+import contextlib
+import functools
+import logging
+import os
+from collections.abc import Iterator
+from typing import BinaryIO
+
+import numpy as np
+
+from . import instructions
+from .blocks import pair_costs, palette_distances, squash_blocks, to_blocks
+from .constants import *
+from .helpers import set_palette
+from .palette import kmeans_444
+from .sources import find_images, load_image
+
+"""
+Encodes a batch of still images into one timed CD+G slideshow.
+"""
+
+# ways to order tile writes within a slide
+ORDERS = ["row", "row_rev", "col", "col_rev", "random"]
+
+# pixels to skip in each direction when sampling slides for the palette
+SAMPLE_STEP = 4
+
+
+def sample_slide(path: str | os.PathLike) -> np.ndarray:
+    "subsample of the pixels of image at `path`, for palette derivation"
+    return load_image(path)[::SAMPLE_STEP, ::SAMPLE_STEP].reshape(-1, 3)
+
+
+def quantize(pixels: np.ndarray, palette: list[tuple[int, int, int]]) -> np.ndarray:
+    "map RGB24 `pixels` to the index of the nearest `palette` color"
+    colors = np.array(palette, dtype=np.int32)
+    diff = pixels[..., None, :].astype(np.int32) - colors
+    return (diff**2).sum(axis=-1).argmin(axis=-1).astype(np.uint8)
+
+
+def squash_slide(path: str | os.PathLike, palette: list[tuple[int, int, int]]) -> np.ndarray:
+    "load image at `path` as full canvas of two-color blocks (runs in worker processes)"
+    distances = palette_distances(palette)
+    indices = quantize(load_image(path), palette)
+    return squash_blocks(to_blocks(indices), distances, pair_costs(distances))
+
+
+def tile_order(rows: np.ndarray, cols: np.ndarray, order="row", rng: np.random.Generator = None) -> np.ndarray:
+    "permutation of blocks at `rows`/`cols` to write them in `order`"
+    assert order in ORDERS, f"unknown tile order {order}!"
+
+    if order == "random":
+        return rng.permutation(len(rows))
+
+    keys = (cols, rows) if order.startswith("row") else (rows, cols)
+    perm = np.lexsort(keys)
+    return perm[::-1] if order.endswith("_rev") else perm
+
+
+class Slideshow:
+    """
+    Encodes a list of images as slides shown for `duration` seconds each.
+
+    All slides share one palette, derived from all of them unless given.
+    Slides are loaded and reduced to blocks in parallel, then only the
+    blocks that differ from the previous slide are written, in `order`.
+    """
+
+    log = logging.getLogger("libcdg.slideshow")
+
+    def __init__(
+        self,
+        images: list[str | os.PathLike],
+        duration=5.0,
+        palette: list[tuple[int, int, int]] = None,
+        order="row",
+        seed: int = None,
+        workers=1,
+    ) -> None:
+        self.images = find_images(images)
+        assert self.images, "no images to encode!"
+        assert order in ORDERS, f"unknown tile order {order}!"
+
+        self.duration = duration
+        self.order = order
+        # seed for random tile order, reproducible output if given
+        self.seed = seed
+        self.workers = workers
+
+        self.packets: list[bytes] = []
+
+        # derived when encoding if not given
+        self.palette = palette
+        self._pool = None
+
+    def map(self, fn, items) -> Iterator:
+        "run `fn` over `items` in order, across worker processes if there are more than one"
+        if self._pool is None:
+            return map(fn, items)
+        return self._pool.map(fn, items)
+
+    def calc_palette(self) -> list[tuple[int, int, int]]:
+        "derive shared palette from samples of every slide"
+        self.log.info(f"calculating palette over {len(self.images)} slides")
+        return kmeans_444(np.concatenate(list(self.map(sample_slide, self.images))))
+
+    def iter_packets(self) -> Iterator[bytes]:
+        "yield stream header, then each slide's packets padded out to its duration"
+
+        header = list(set_palette(list(self.palette)))
+        header += [instructions.preset_memory(0), instructions.preset_border(0)]
+        yield b"".join(header)
+
+        # model of what is on screen
+        screen = np.zeros((FULL_HEIGHT_BLOCKS, FULL_WIDTH_BLOCKS, BLOCK_HEIGHT, BLOCK_WIDTH), dtype=np.uint8)
+
+        # packet each slide should end at, keeps later slides on time after a slow one
+        clock = written = len(header)
+        slide_packets = round(self.duration * PACKETS_PER_SECOND)
+
+        slides = self.map(functools.partial(squash_slide, palette=self.palette), self.images)
+        for i, (path, blocks) in enumerate(zip(self.images, slides)):
+            rows, cols = np.nonzero((blocks != screen).any(axis=(-2, -1)))
+            rng = np.random.default_rng(None if self.seed is None else [self.seed, i])
+            perm = tile_order(rows, cols, self.order, rng)
+            rows, cols = rows[perm], cols[perm]
+
+            # blocks are already squashed to two colors, lower index is fg
+            data = blocks[rows, cols]
+            flat = data.reshape(len(data), BLOCK_HEIGHT * BLOCK_WIDTH)
+            fg, bg = flat.min(axis=1, initial=PALETTE_SIZE), flat.max(axis=1, initial=0)
+            packets = instructions.font_blocks(rows, cols, bg, fg, data == fg[:, None, None])
+
+            screen[rows, cols] = data
+
+            if len(rows) > slide_packets:
+                seconds = len(rows) / PACKETS_PER_SECOND
+                self.log.warning(f"slide {path} takes {seconds:.1f}s to draw, longer than its duration")
+            self.log.debug(f"slide {path}: {len(rows)} blocks")
+
+            # hold slide until the next one is due
+            clock += slide_packets
+            padding = max(0, clock - written - len(rows))
+            written += len(rows) + padding
+            yield packets.tobytes() + instructions.nop() * padding
+
+    def encode(self, sink: BinaryIO = None):
+        "Encode slides, into memory for `save()` or streamed out to file-like `sink`"
+        pool = concurrent.futures.ProcessPoolExecutor(self.workers) if self.workers > 1 else contextlib.nullcontext()
+        with pool as self._pool:
+            try:
+                if self.palette is None:
+                    self.palette = self.calc_palette()
+
+                for chunk in self.iter_packets():
+                    if sink is None:
+                        self.packets += [chunk[i : i + PACKET_SIZE] for i in range(0, len(chunk), PACKET_SIZE)]
+                    else:
+                        sink.write(chunk)
+            finally:
+                self._pool = None
+        return self
+
+    def save(self, name: str, overwrite=False):
+        "Save encoded CDG stream to `name`.cdg"
+        assert len(self.packets) != 0, "cannot save before encoding! run `encode()` first"
+        self.log.info(f"saving to {name}.cdg")
+
+        mode = "wb" if overwrite else "xb"
+        with open(f"{name}.cdg", mode=mode) as cdgfile:
+            cdgfile.writelines(self.packets)
@@ -0,0 +1,366 @@
+import abc
+import asyncio
+import itertools
+import math
+import os
+import subprocess
+from collections.abc import AsyncIterator, Iterable, Iterator
+from pathlib import Path
+
+import ffmpeg
+import numpy as np
+from PIL import Image, ImageOps
+
+from .cache import file_digest
+from .constants import *
+
+"""
+Sources of frames for the encoder.
+
+Every source produces full canvas (216, 300, 3) RGB24 arrays at the encoder
+frame rate, so the encoder does not care where they came from.
+"""
+
+IMAGE_SUFFIXES = {".png", ".jpg", ".jpeg", ".gif", ".bmp", ".tif", ".tiff", ".webp"}
+
+FRAME_SHAPE = (FULL_HEIGHT, FULL_WIDTH, 3)
+
+# frames decoded into reused buffers stay valid for this many frames
+RING_SIZE = 8
+
+# frames after each sample point to look through for a scene change, when sampling at scene changes
+SCENE_SEARCH_FRAMES = 30
+
+# how different from the one before a frame has to be to count as a scene change
+SCENE_THRESHOLD = 0.3
+
+
+def find_images(paths: list[str | os.PathLike]) -> list[Path]:
+    "expand any directories in `paths` to the images in them, in name order"
+    images = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            images += sorted(p for p in path.iterdir() if p.suffix.lower() in IMAGE_SUFFIXES)
+        else:
+            images.append(path)
+    return images
+
+
+def load_image(path: str | os.PathLike, fill_frame=False) -> np.ndarray:
+    """
+    Load image at `path` as a full canvas RGB24 array.
+
+    Images are stretched to the full canvas with `fill_frame`, otherwise any
+    that are not full canvas size are fit inside the visible area and padded
+    with black, so nothing ends up under the border.
+    """
+    with Image.open(path) as image:
+        image = image.convert("RGB")
+        if image.size != (FULL_WIDTH, FULL_HEIGHT):
+            if fill_frame:
+                image = image.resize((FULL_WIDTH, FULL_HEIGHT), Image.Resampling.NEAREST)
+            else:
+                image = ImageOps.pad(image, (DISPLAY_WIDTH, DISPLAY_HEIGHT))
+                image = ImageOps.pad(image, (FULL_WIDTH, FULL_HEIGHT))
+        return np.asarray(image)
+
+
+def read_frame(stream, frame: np.ndarray) -> bool:
+    "fill `frame` from binary `stream`, returns false if there was no whole frame left"
+    view = memoryview(frame).cast("B")
+    filled = 0
+    while filled < len(view):
+        if not (read := stream.readinto(view[filled:])):
+            break
+        filled += read
+    return filled == len(view)
+
+
+class FrameSource(abc.ABC):
+    "Base for anything that produces frames to encode, which has to implement `frames()`"
+
+    # file to take the audio track from, if any
+    audio: str | None = None
+
+    @abc.abstractmethod
+    def frames(self, start=0, count=None, palette: str | None = None) -> Iterator[np.ndarray]:
+        """
+        Yield `count` frames (or all of them) from frame `start` onwards.
+
+        Sources that can do their own color mapping may map frames to the
+        colors of palette image file `palette`, if given.
+        """
+
+    async def aframes(
+        self, start=0, count=None, palette: str | None = None, executor=None
+    ) -> AsyncIterator[np.ndarray]:
+        "async version of `frames()`, by default reading each frame in `executor`"
+        loop = asyncio.get_running_loop()
+        frames = self.frames(start, count, palette)
+        done = object()
+        try:
+            while (frame := await loop.run_in_executor(executor, next, frames, done)) is not done:
+                # copy, as the next read may reuse the buffer while this one is in use
+                yield frame.copy()
+        finally:
+            frames.close()
+
+    def frame_count(self) -> int | None:
+        "number of frames the source will produce, if known"
+        return None
+
+    def sample(self, count: int, method="uniform") -> np.ndarray:
+        "up to `count` frames spread evenly over the source, for palette estimation"
+        total = self.frame_count()
+        assert total, "cannot sample a source of unknown length, give a palette instead!"
+
+        picks = set(np.linspace(0, total - 1, min(count, total)).round().astype(int).tolist())
+        # copy, as frames may be reused buffers
+        return np.array([frame.copy() for i, frame in enumerate(self.frames()) if i in picks])
+
+    def digest(self) -> str | None:
+        "hash of source contents for cache keys, or None if it should not be cached"
+        return None
+
+
+class FFmpegSource(FrameSource):
+    "Decodes and scales any file ffmpeg can read, at `frame_rate`"
+
+    def __init__(
+        self,
+        path: str | os.PathLike,
+        frame_rate=15,
+        fill_frame=False,
+        mono=False,
+        monitor: str | os.PathLike = None,
+        quiet=True,
+    ) -> None:
+        self.path = str(path)
+        self.audio = self.path
+
+        self.frame_rate = frame_rate
+        self.fill_frame = fill_frame
+        self.mono = mono
+        # optional preview of the palette-mapped input
+        self.monitor = str(monitor) if monitor else None
+        self.quiet = quiet
+
+        self._digest = None
+
+    def scale_input(self, start=0, count=None):
+        """
+        shared scale input video scale ffmpeg pipeline, optionally seeking to frame `start`
+        and reading only `count` frames worth of input
+        """
+
+        # seek on input, so segments dont decode everything before them
+        seek = {"ss": start / self.frame_rate} if start else {}
+        if count is not None:
+            seek["t"] = count / self.frame_rate
+
+        # create scale pipeline
+        ppl = (
+            ffmpeg.input(self.path, **seek)
+            # ensure 30fps to better match packet rate
+            .filter("fps", fps=self.frame_rate)
+        )
+
+        # scale to CDG canvas size (either display or full)
+        if self.fill_frame:
+            ppl = ppl.filter("scale", width=FULL_WIDTH, height=FULL_HEIGHT, flags="neighbor")
+        else:
+            ppl = (
+                ppl.filter("scale", width=DISPLAY_WIDTH, height=DISPLAY_HEIGHT, flags="neighbor")
+                # still pad back up to full size so it is centered
+                .filter("pad", width=FULL_WIDTH, height=FULL_HEIGHT, x=-1, y=-1)
+            )
+
+        if self.mono:  # force 1-bit black/white (a la Bad Apple)
+            dim = f"s={FULL_WIDTH}x{FULL_HEIGHT}"
+            black = ffmpeg.input(f"color=Black:{dim}", f="lavfi")
+            white = ffmpeg.input(f"color=White:{dim}", f="lavfi")
+            gray = ffmpeg.input(f"color=DarkGray:{dim}", f="lavfi")
+
+            ppl = ffmpeg.filter([ppl, gray, black, white], "threshold")
+
+        return ppl
+
+    def graph(self, start=0, count=None, palette: str | None = None):
+        """
+        ffmpeg graph to output frames over pipe, optionally for a segment only.
+
+        If a monitor file was requested, it is written from the same decode.
+        """
+
+        limit = {"vframes": count} if count is not None else {}
+
+        mapped = self.scale_input(start)
+        if palette:
+            mapped = ffmpeg.filter([mapped, ffmpeg.input(filename=palette)], "paletteuse")
+
+        # only write monitor for whole video, not segments
+        if self.monitor and start == 0 and count is None:
+            split = mapped.filter_multi_output("split")
+            ppl = ffmpeg.merge_outputs(
+                split[0].output("pipe:", format="rawvideo", pix_fmt="rgb24"),
+                split[1].output(self.monitor),
+            ).overwrite_output()
+        else:
+            ppl = mapped.output("pipe:", format="rawvideo", pix_fmt="rgb24", **limit)
+
+        return ppl.global_args("-hide_banner", "-loglevel", "warning")
+
+    def start(self, start=0, count=None, palette: str | None = None) -> subprocess.Popen:
+        "Captures output frames from ffmpeg over pipe, see `graph()`"
+        return self.graph(start, count, palette).run_async(pipe_stdout=True)
+
+    def frames(self, start=0, count=None, palette: str | None = None) -> Iterator[np.ndarray]:
+        """
+        Yield frames read straight from ffmpeg into a ring of reused buffers.
+
+        Each frame is only valid until RING_SIZE more have been read, so copy
+        any that need to be kept around longer.
+        """
+        ring = [np.empty(FRAME_SHAPE, dtype=np.uint8) for _ in range(RING_SIZE)]
+
+        with self.start(start, count, palette) as ffpipe:
+            # get next frame from ffmpeg subprocess until exhausted
+            for frame in itertools.cycle(ring):
+                if not read_frame(ffpipe.stdout, frame):
+                    return
+                yield frame
+
+    async def aframes(
+        self, start=0, count=None, palette: str | None = None, executor=None
+    ) -> AsyncIterator[np.ndarray]:
+        "async version of `frames()`, running ffmpeg as an asyncio subprocess"
+        frame_size = math.prod(FRAME_SHAPE)
+
+        process = await asyncio.create_subprocess_exec(
+            *self.graph(start, count, palette).compile(),
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+        )
+        try:
+            while True:
+                try:
+                    framebytes = await process.stdout.readexactly(frame_size)
+                except asyncio.IncompleteReadError:
+                    break
+                yield np.frombuffer(framebytes, dtype=np.uint8).reshape(FRAME_SHAPE)
+            await process.wait()
+        finally:
+            # stopped early or cancelled
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+
+    def frame_count(self) -> int:
+        probe = ffmpeg.probe(self.path)
+        duration = float(probe["format"]["duration"])
+        return math.ceil(duration * self.frame_rate)
+
+    def sample(self, count: int, method="uniform") -> np.ndarray:
+        """
+        Up to `count` frames spread evenly over the source, each decoded by seeking straight to it.
+
+        With the `scene` method, each sample is the first scene change within
+        SCENE_SEARCH_FRAMES of its spot if there is one, so samples favour new
+        shots but still cover the whole duration.
+        """
+        assert method in ["uniform", "scene"], f"unknown sampling method {method}!"
+
+        total = self.frame_count()
+        picks = np.unique(np.linspace(0, total - 1, min(count, total)).round().astype(int))
+
+        samples = []
+        for start in picks.tolist():
+            if method == "uniform":
+                ppl = self.scale_input(start)
+                limit, timing = 1, {}
+            else:
+                # first frame of the stretch, then the first scene change in it if any
+                ppl = self.scale_input(start, SCENE_SEARCH_FRAMES).filter(
+                    "select", f"eq(n,0)+gt(scene,{SCENE_THRESHOLD})"
+                )
+                # only output the selected frames, dont duplicate to fill gaps
+                limit, timing = 2, {"fps_mode": "vfr"}
+
+            out, _err = (
+                ppl.output("pipe:", format="rawvideo", pix_fmt="rgb24", vframes=limit, **timing)
+                .global_args("-hide_banner", "-loglevel", "warning")
+                .run(capture_stdout=True, quiet=self.quiet)
+            )
+            frames = np.frombuffer(out, dtype=np.uint8).reshape(-1, *FRAME_SHAPE)
+            if len(frames):
+                samples.append(frames[-1])
+
+        return np.array(samples)
+
+    def digest(self) -> str:
+        if self._digest is None:
+            self._digest = file_digest(self.path)
+        return self._digest
+
+
+class ImageDirSource(FrameSource):
+    "Image files as a sequence of frames, one image per frame"
+
+    def __init__(self, paths: str | os.PathLike | list[str | os.PathLike], fill_frame=False) -> None:
+        "`paths` can be image files, or directories of them which are read in name order"
+        if isinstance(paths, (str, os.PathLike)):
+            paths = [paths]
+        self.images = find_images(paths)
+        assert self.images, "no images found!"
+
+        self.fill_frame = fill_frame
+
+    def frames(self, start=0, count=None, palette: str | None = None) -> Iterator[np.ndarray]:
+        end = None if count is None else start + count
+        for path in self.images[start:end]:
+            yield load_image(path, self.fill_frame)
+
+    def frame_count(self) -> int:
+        return len(self.images)
+
+    def sample(self, count: int, method="uniform") -> np.ndarray:
+        # only load the images that get picked
+        picks = np.linspace(0, len(self.images) - 1, min(count, len(self.images))).round().astype(int)
+        return np.array([load_image(self.images[i], self.fill_frame) for i in np.unique(picks)])
+
+
+class ArraySource(FrameSource):
+    """
+    Frames that are already decoded, from an (N, 216, 300, 3) array or any
+    iterable of frames. Either is cast to 8-bit RGB if it is not already.
+
+    Iterables other than arrays (like generators) can only be read once, in
+    order, and have no known length.
+    """
+
+    def __init__(self, frames: np.ndarray | Iterable[np.ndarray]) -> None:
+        if isinstance(frames, np.ndarray):
+            frames = np.asarray(frames, dtype=np.uint8)
+            assert frames.shape[1:] == FRAME_SHAPE, f"frames should be {FRAME_SHAPE}, got {frames.shape[1:]}!"
+        self._frames = frames
+
+    def frames(self, start=0, count=None, palette: str | None = None) -> Iterator[np.ndarray]:
+        end = None if count is None else start + count
+        if isinstance(self._frames, np.ndarray):
+            yield from self._frames[start:end]
+            return
+
+        for frame in itertools.islice(self._frames, start, end):
+            frame = np.asarray(frame, dtype=np.uint8)
+            assert frame.shape == FRAME_SHAPE, f"frames should be {FRAME_SHAPE}, got {frame.shape}!"
+            yield frame
+
+    def frame_count(self) -> int | None:
+        if isinstance(self._frames, np.ndarray):
+            return len(self._frames)
+        return None
+
+    def sample(self, count: int, method="uniform") -> np.ndarray:
+        total = self.frame_count()
+        assert total, "cannot sample frames from a generator, give a palette image or list of colors instead!"
+        return self._frames[np.unique(np.linspace(0, total - 1, min(count, total)).round().astype(int))]
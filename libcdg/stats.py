@@ -0,0 +1,166 @@
+import array
+import json
+import os
+import threading
+import time
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+
+"""
+Lightweight per-frame statistics for encodes.
+"""
+
+
+class EncodeStats:
+    """
+    Per-frame stage timings and counters for an encode.
+
+    Values are kept in flat typed arrays (one per column), so collecting them
+    costs a few clock reads per frame and a few bytes of memory per frame.
+    Time spent writing a frame's packets out is counted towards the next one.
+
+    Frames produced ahead in another thread (see `produce()`) keep their times
+    apart, and count them towards the frame they were spent on once it is used.
+    """
+
+    STAGES = ["decode", "blocks", "scroll", "updates", "schedule", "packets", "output"]
+    COUNTERS = ["changed", "written", "backlog", "nops", "dropped"]
+
+    def __init__(self, packets_per_frame: int) -> None:
+        self.packets_per_frame = packets_per_frame
+
+        self.times = {name: array.array("d") for name in self.STAGES + ["total"]}
+        self.counts = {name: array.array("q") for name in self.COUNTERS}
+        # one-off timings outside the frame loop
+        self.other = {}
+
+        self.packets = 0
+        self.start = time.perf_counter()
+
+        self._frame_start = self.start
+        self._pending = dict.fromkeys(self.STAGES, 0.0)
+        # times of threads producing frames ahead, by thread id
+        self._ahead: dict[int, dict[str, float]] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        "count time spent in block towards stage `name` of the current frame"
+        pending = self._ahead.get(threading.get_ident(), self._pending)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            pending[name] += time.perf_counter() - start
+
+    def produce(self, it: Iterable) -> Iterator[tuple]:
+        """
+        wrap iterable `it` to be run in another thread, yielding each item with
+        the stage times spent producing it there, to be unwrapped by `consume()`
+        """
+        thread = threading.get_ident()
+        pending = self._ahead[thread] = dict.fromkeys(self.STAGES, 0.0)
+        try:
+            for item in it:
+                times = pending.copy()
+                for name in pending:
+                    pending[name] = 0.0
+                yield item, times
+        finally:
+            del self._ahead[thread]
+
+    def consume(self, it: Iterable[tuple]) -> Iterator:
+        "unwrap items from `produce()`, counting their times towards the frame using them"
+        for item, times in it:
+            for name, seconds in times.items():
+                self._pending[name] += seconds
+            yield item
+
+    @contextmanager
+    def timing(self, name: str):
+        "time a one-off step outside the frame loop"
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.other[name] = self.other.get(name, 0.0) + time.perf_counter() - start
+
+    def timed(self, it: Iterable, name: str) -> Iterator:
+        "wrap iterable `it`, counting time spent fetching each item towards stage `name`"
+        it = iter(it)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def end_frame(self, changed: int, written: int, backlog: int, packets: int, nops: int, dropped=0):
+        "record counters for the frame just encoded, and start the next one"
+        now = time.perf_counter()
+
+        for name, seconds in self._pending.items():
+            self.times[name].append(seconds)
+            self._pending[name] = 0.0
+        self.times["total"].append(now - self._frame_start)
+        self._frame_start = now
+
+        self.counts["changed"].append(changed)
+        self.counts["written"].append(written)
+        self.counts["backlog"].append(backlog)
+        self.counts["nops"].append(nops)
+        self.counts["dropped"].append(dropped)
+
+        self.packets += packets
+
+    def merge(self, other: "EncodeStats"):
+        "append frames and timings of `other`, e.g. from the next segment of a parallel encode"
+        for name, values in other.times.items():
+            self.times[name].extend(values)
+        for name, values in other.counts.items():
+            self.counts[name].extend(values)
+        for name, seconds in other.other.items():
+            self.other[name] = self.other.get(name, 0.0) + seconds
+        self.packets += other.packets
+
+    @property
+    def frames(self) -> int:
+        return len(self.times["total"])
+
+    def elapsed(self) -> float:
+        "wall time since encode started, in seconds"
+        return time.perf_counter() - self.start
+
+    def summary(self) -> dict:
+        "totals and averages over the whole encode"
+        frames = max(self.frames, 1)
+        elapsed = self.elapsed()
+        return {
+            "frames": self.frames,
+            "packets": self.packets,
+            "elapsed": elapsed,
+            "fps": self.frames / elapsed,
+            "packets_per_second": self.packets / elapsed,
+            "stage_seconds": {name: sum(values) for name, values in self.times.items()},
+            "mean_changed": sum(self.counts["changed"]) / frames,
+            "mean_written": sum(self.counts["written"]) / frames,
+            "mean_backlog": sum(self.counts["backlog"]) / frames,
+            "nop_ratio": sum(self.counts["nops"]) / (frames * self.packets_per_frame),
+            "dropped_frames": sum(self.counts["dropped"]),
+            "other_seconds": dict(self.other),
+        }
+
+    def to_dict(self, per_frame=True) -> dict:
+        "summary, plus columns of per-frame values if `per_frame`"
+        stats = {"summary": self.summary()}
+        if per_frame:
+            stats["frames"] = {
+                **{name: values.tolist() for name, values in self.times.items()},
+                **{name: values.tolist() for name, values in self.counts.items()},
+            }
+        return stats
+
+    def save(self, path: str | os.PathLike, per_frame=True):
+        "write stats out as JSON to `path`"
+        with open(path, "w") as f:
+            json.dump(self.to_dict(per_frame), f)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+slides2cdg: encode still images as a CD+G slideshow
+
+Usage:
+    slides2cdg <images>... [options]
+
+Options:
+    -o, --output <output.cdg>   Target filename [default: slideshow.cdg]
+    -f, --force                 Overwrite output file, if it exists
+    -v, --verbose               Show progress
+    --duration <seconds>        Time each slide is shown for [default: 5]
+    --palette <image>           Take palette from this image instead of deriving one from all slides
+    --order <order>             Order to draw tiles in: row, row_rev, col, col_rev or random [default: row]
+    --seed <n>                  Seed for random tile order, for reproducible output
+    --workers <n>               Load slides in parallel across this many processes [default: 1]
+
+Images can be given as files or directories of images, which are shown in name order.
+"""
+
+import logging
+from pathlib import Path
+
+import docopt
+import numpy as np
+from PIL import Image
+
+from libcdg.palette import kmeans_444
+from libcdg.slideshow import Slideshow
+
+ARGS = docopt.docopt(__doc__)
+
+outpath = Path(ARGS["--output"])
+out = outpath.parent / outpath.stem
+
+if outpath.exists() and not ARGS["--force"]:
+    print("ERR: output file exists, use -f to overwrite")
+    exit(1)
+
+if ARGS["--verbose"]:
+    logging.basicConfig(level=logging.INFO)
+
+palette = None
+if ARGS["--palette"]:
+    with Image.open(ARGS["--palette"]) as image:
+        palette = kmeans_444(np.asarray(image.convert("RGB")))
+
+slides = Slideshow(
+    ARGS["<images>"],
+    duration=float(ARGS["--duration"]),
+    palette=palette,
+    order=ARGS["--order"],
+    seed=None if ARGS["--seed"] is None else int(ARGS["--seed"]),
+    workers=int(ARGS["--workers"]),
+)
+slides.encode().save(out, overwrite=True)
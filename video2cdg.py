@@ -3,24 +3,60 @@
 video2cdg: convert video to CD+G graphics
 
 Usage:
-    video2cdg <input.mp4> [--output <output.cdg>] [-f] [-v] [--mono] [--palette <image>] [--monitor <path/to.mp4>]
+    video2cdg <input.mp4> [options]
 
 Options:
-    -o, --output <output.cdg>   Target filename. Will also create output.mp3. Default: input filename
+    -o, --output <output.cdg>   Target filename. Will also create output.mp3 (or other --audio-format). Default: input filename
     -f, --force                 Overwrite output files, if they exist
     -v, --verbose               Show ffmpeg transcode output
     --palette <image>           Palette to use instead of generating one from input
+    --palette-method <method>   How to derive palette from input: sample `uniform` frames, frames at
+                                `scene` changes, or ffmpeg `palettegen` over the whole input [default: uniform]
     --mono                      Use 1-bit black/white for video instead of color
+    --monitor <path/to.mp4>     Also write the palette-mapped input video here, for previewing
+    --squash <engine>           Block color reduction engine, `numpy` or `pil` [default: numpy]
+    --lookahead <frames>        Look this many frames ahead to avoid writing blocks about to change [default: 0]
+    --scroll                    Use scroll instructions for whole-screen pans and crawls, of up to
+                                3 blocks (18 px across or 36 px down) per frame
+    --scenes <mode>             Detect hard cuts, and clear the screen at them when one color dominates (`cuts`),
+                                or also switch to a palette for each scene (`palettes`)
+    --cut-threshold <share>     Share of the picture that has to change for a cut [default: 0.5]
+    --priority <metric>         Rank changed blocks by how different the colors look (`perceptual`),
+                                or by number of changed pixels (`pixels`) [default: pixels]
+    --threshold <amount>        Smallest change worth writing a block for: pixels, or black to white
+                                pixels for `perceptual`, counted in steps of 1/255 of one.
+                                Default: 4 pixels, or 1.0 perceptual
+    --spatial <weight>          Count perceptual changes up to this much more when next to other
+                                changed pixels [default: 0]
+    --workers <n>               Encode time segments in parallel across this many processes [default: 1]
+    --pipeline                  Decode and write in background threads, overlapping with encoding
+    --no-cache                  Do not use or update the palette/frame cache
+    --clear-cache               Empty the cache before encoding
+    --cache-frames              Also cache the decoded frames, so repeat runs skip decoding entirely
+    --stats <file.json>         Write per-frame encode timings and counters here
+    --audio-format <ext>        Audio file to write alongside: mp3, ogg, opus, m4a, flac or wav [default: mp3]
+    --audio-bitrate <rate>      Audio bitrate, like 192k. Default: encoder default
+    --audio-copy                Copy the source audio as-is if its codec fits the audio format
+    --live <target>             Stream packets in real time instead of writing files, to `-` (stdout),
+                                a FIFO path, or tcp://host:port (waits for a client to connect)
+    --latency <seconds>         How far ahead of real time to send live packets [default: 0.1]
+    --checkpoint <frames>       Save encoder state next to the output every this many frames
+    --resume                    Carry on a stopped encode from its last checkpoint
+    --reencode <from:to>        Re-encode only this time range (in seconds) of the existing output,
+                                in place. Give the palette it was encoded with
 """
 
 import os
+import sys
 from pathlib import Path
 
 import docopt
 import ffmpeg
 
 from libcdg import libcdg
+from libcdg.cache import Cache
 from libcdg.constants import DISPLAY_HEIGHT, DISPLAY_WIDTH
+from libcdg.live import open_live_sink
 
 import logging
 logging.basicConfig(level="DEBUG")
@@ -36,23 +72,82 @@ ARGS = docopt.docopt(__doc__)
 infile = ARGS["<input.mp4>"]
 monfile = ARGS["--monitor"]
 palette = ARGS["--palette"]
+palette_method = ARGS["--palette-method"]
 quiet = not ARGS["--verbose"]
 mono = ARGS["--mono"]
 overwrite = ARGS["--force"]
+squash = ARGS["--squash"]
+workers = int(ARGS["--workers"])
+lookahead = int(ARGS["--lookahead"])
+scroll = ARGS["--scroll"]
+scenes = ARGS["--scenes"]
+cut_threshold = float(ARGS["--cut-threshold"])
+priority = ARGS["--priority"]
+threshold = float(ARGS["--threshold"]) if ARGS["--threshold"] else None
+spatial = float(ARGS["--spatial"])
+pipeline = ARGS["--pipeline"]
+audio_format = ARGS["--audio-format"]
+audio_bitrate = ARGS["--audio-bitrate"]
+audio_copy = ARGS["--audio-copy"]
+cache_frames = ARGS["--cache-frames"]
+stats_file = ARGS["--stats"]
+live = ARGS["--live"]
+latency = float(ARGS["--latency"])
+checkpoint_every = int(ARGS["--checkpoint"]) if ARGS["--checkpoint"] else None
+resume = ARGS["--resume"]
+reencode = ARGS["--reencode"]
 
 # remove ext
 outpath = Path(ARGS["--output"] or infile)
 out = outpath.parent / outpath.stem
 
 if not quiet:
-    print(f"args: {ARGS}")
+    # stdout may be the live stream
+    print(f"args: {ARGS}", file=sys.stderr)
 
-if outpath.exists() and not overwrite:
+if not (live or resume or reencode) and outpath.exists() and not overwrite:
     print("ERR: output file exists, use -f to overwrite")
     exit(1)
 
-cdg = libcdg.Video(infile, palette=palette, mono=mono, quiet=quiet)
-cdg.encode().save(out, overwrite=True)
+if ARGS["--clear-cache"]:
+    Cache().clear()
+cache = None if ARGS["--no-cache"] else Cache()
+
+cdg = libcdg.Video(
+    infile,
+    palette=palette,
+    palette_method=palette_method,
+    mono=mono,
+    quiet=quiet,
+    squash=squash,
+    lookahead=lookahead,
+    scroll=scroll,
+    scenes=scenes,
+    cut_threshold=cut_threshold,
+    priority=priority,
+    threshold=threshold,
+    spatial=spatial,
+    pipeline=pipeline,
+    audio_format=audio_format,
+    audio_bitrate=audio_bitrate,
+    audio_copy=audio_copy,
+    monitor=monfile,
+    cache=cache,
+    cache_frames=cache_frames,
+)
+if live:
+    try:
+        cdg.live(open_live_sink(live), latency=latency)
+    except (BrokenPipeError, ConnectionResetError):
+        print("live output closed", file=sys.stderr)
+elif reencode:
+    start, end = (round(float(t) * cdg.FRAME_RATE) for t in reencode.split(":"))
+    cdg.reencode(f"{out}.cdg", start, end - start)
+else:
+    cdg.stream(out, overwrite=True, workers=workers, checkpoint_every=checkpoint_every, resume=resume)
+
+if stats_file:
+    cdg.stats.save(stats_file)
 
 
 # # 4. output .cdg + .mp3